@@ -6,103 +6,742 @@
     Variables:
         TEMPLATES_BUCKET - S3 buckets storing user defined Icinga2 objects
                            YAML templates
+        STATE_BUCKET - S3 bucket storing lambda2icinga state objects
+                       (Optional. Defaults to: TEMPLATES_BUCKET)
+        INSTANCE_STATE_KEY - S3 key of monitored instances state
+                             (Optional. Defaults to:
+                             lambda2icinga/instance-state.json)
         API_USER - Icinga2 API user
         API_PASS - Icinga2 API password
         API_PORT - Icinga2 API port
         API_ENDPOINT - Icinga2 API endpoint
+        DESCRIBE_PAGE_SIZE - Number of instances requested per
+                             describe_instances page
+                             (Optional. Defaults to: 1000)
+        DISCOVERY_REGIONS - Comma separated regions EC2 instances are
+                            discovered in
+                            (Optional. Defaults to: AWS_DEFAULT_REGION)
+        DISCOVERY_ROLE_ARNS - Comma separated IAM roles assumed to discover
+                              EC2 instances of other accounts, in addition
+                              to the Lambda account (Optional)
+        DISCOVERY_CONCURRENCY - Number of (account, region) pairs described
+                                concurrently (Optional. Defaults to: 8)
+        TEMPLATE_CACHE_TTL - Seconds before cached template is revalidated
+                             against S3 (Optional. Defaults to: 300)
+        TEMPLATE_CACHE_SIZE - Maximum number of cached templates
+                              (Optional. Defaults to: 64)
+        RENDER_CACHE_SIZE - Maximum number of objects blocks rendered once
+                            per template and shared by hosts
+                            (Optional. Defaults to: 256)
+        API_POOL_SIZE - Maximum number of kept alive connections to Icinga2
+                        API (Optional. Defaults to: 10)
+        API_CONNECT_TIMEOUT - Icinga2 API connect timeout in seconds
+                              (Optional. Defaults to: 3.05)
+        API_READ_TIMEOUT - Icinga2 API read timeout in seconds
+                           (Optional. Defaults to: 30)
+        API_MAX_RETRIES - Number of retries for failed Icinga2 API requests
+                          (Optional. Defaults to: 3)
+        API_RETRY_BACKOFF - Exponential backoff factor between retries
+                            (Optional. Defaults to: 0.5)
+        PROVISION_CONCURRENCY - Number of hosts provisioned concurrently
+                                (Optional. Defaults to: 8)
+        PROVISION_DEADLINE_MARGIN - Milliseconds before invocation timeout
+                                    when no new hosts are scheduled
+                                    (Optional. Defaults to: 10000)
+        TEARDOWN_RATE - Maximum number of Icinga2 package deletions per
+                        second (Optional. Defaults to: 20)
+        NEW_HOST_DOWNTIME - Minutes newly monitored host check is downtimed
+                            (Optional. Defaults to: 15)
+        DOWNTIME_CHUNK_SIZE - Maximum number of hosts downtimed by single
+                              request (Optional. Defaults to: 100)
+        FLEET_PACKAGE - Icinga2 package storing every host configuration.
+                        When set, changed hosts are uploaded in batches as
+                        single stage (Optional. Defaults to: package per host)
+        FLEET_BATCH_SIZE - Maximum number of changed hosts per fleet stage
+                           upload (Optional. Defaults to: 500)
+        FLEET_FLUSH_INTERVAL - Seconds before queued hosts are uploaded
+                               (Optional. Defaults to: 30)
+        STAGE_VALIDATION_TIMEOUT - Seconds stage uploaded to fleet or
+                                   services package may stay inactive
+                                   before next stages stop building on it
+                                   (Optional. Defaults to: 300)
+        SERVICE_APPLY_PACKAGE - Icinga2 package storing services of every
+                                service template as shared template and
+                                apply rule. When set, host packages only
+                                mark their service template
+                                (Optional. Defaults to: services per host)
+        LOG_LEVEL - Logging verbosity, API responses and instances metadata
+                    are logged at DEBUG level (Optional. Defaults to: INFO)
+        LOG_FORMAT - "json" for structured log records, "text" for plain
+                     messages (Optional. Defaults to: text)
+        LOG_MAX_PAYLOAD - Number of characters after which logged payloads
+                          (events, API responses, configuration) are
+                          summarized (Optional. Defaults to: 2048)
+        LOG_SAMPLE_RATE - Ratio of invocations logging payloads in full
+                          (Optional. Defaults to: 0)
+        METRICS_NAMESPACE - CloudWatch namespace of invocation metrics
+                            printed in Embedded Metric Format, empty value
+                            disables metrics
+                            (Optional. Defaults to: lambda2icinga)
 """
+import time
+MODULE_LOAD_START = time.time()
 from os import environ
 import sys
 import logging
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import unquote_plus
 from datetime import datetime, timedelta
 import calendar
 import json
+import hashlib
+import re
+import random
+from contextlib import contextmanager
+# boto3 and requests are needed by every event, import them during Lambda
+# init phase. jinja2 and yaml are imported on first use, as delete-only
+# events do not render any templates
 import boto3
-from botocore.errorfactory import ClientError
-import yaml
+from botocore.exceptions import ClientError
 import requests
-from jinja2 import Environment
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+IMPORT_DURATION = (time.time() - MODULE_LOAD_START) * 1000
 
 # Configure LOGGER object
 LOGGER = logging.getLogger()
-LOGGER.setLevel(logging.INFO)
+LOGGER.setLevel(environ.get('LOG_LEVEL', 'INFO').upper())
+LOG_FORMAT = environ.get('LOG_FORMAT', 'text')
+# Logged payloads longer than LOG_MAX_PAYLOAD characters are summarized,
+# unless invocation was sampled (LOG_SAMPLE_RATE) to log them in full
+LOG_MAX_PAYLOAD = int(environ.get('LOG_MAX_PAYLOAD', 2048))
+LOG_SAMPLE_RATE = float(environ.get('LOG_SAMPLE_RATE', 0))
+LOG_SAMPLED = False
+
+
+class LogPayload(object):
+    """
+        Payload formatted only when log record is emitted. Payload longer
+        than LOG_MAX_PAYLOAD is summarized by its size and digest, unless
+        current invocation is sampled
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value() if callable(self.value) else self.value
+        if isinstance(value, str):
+            text = value
+        else:
+            try:
+                text = json.dumps(value, sort_keys=True, default=str)
+            except (TypeError, ValueError):
+                text = str(value)
+        if LOG_SAMPLED or len(text) <= LOG_MAX_PAYLOAD:
+            return text
+        summary = "... <{0} chars".format(len(text))
+        if isinstance(value, (list, dict)):
+            summary += ", {0} items".format(len(value))
+        summary += ", sha256 {0}>".format(hashlib.sha256(text.encode('utf-8')).hexdigest()[:16])
+        return text[:LOG_MAX_PAYLOAD] + summary
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+        Format log records as single line JSON objects
+    """
+
+    def format(self, record):
+        entry = {'timestamp': self.formatTime(record),
+                 'level': record.levelname,
+                 'message': record.getMessage()}
+        request_id = getattr(record, 'aws_request_id', None)
+        if request_id is not None:
+            entry['aws_request_id'] = request_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+if LOG_FORMAT == 'json':
+    if not LOGGER.handlers:
+        LOGGER.addHandler(logging.StreamHandler())
+    for log_handler in LOGGER.handlers:
+        log_handler.setFormatter(JsonLogFormatter())
+
+# Set until the first invocation handled by this Lambda container
+COLD_START = True
+
+# Number of instances requested per describe_instances call (5 - 1000)
+DESCRIBE_PAGE_SIZE = int(environ.get('DESCRIBE_PAGE_SIZE', 1000))
+# Maximum number of values per describe_instances filter
+EC2_FILTER_CHUNK = 200
+# Instances are discovered in every DISCOVERY_REGIONS region of the Lambda
+# account and of each DISCOVERY_ROLE_ARNS account, DISCOVERY_CONCURRENCY
+# (account, region) pairs at a time
+DISCOVERY_REGIONS = [region.strip() for region
+                     in environ.get('DISCOVERY_REGIONS', '').split(',')
+                     if region.strip()]
+DISCOVERY_ROLE_ARNS = [role_arn.strip() for role_arn
+                       in environ.get('DISCOVERY_ROLE_ARNS', '').split(',')
+                       if role_arn.strip()]
+DISCOVERY_CONCURRENCY = int(environ.get('DISCOVERY_CONCURRENCY', 8))
+# Instances with monitoring enabled
+MONITORING_ENABLED_FILTER = {
+    "Name": "tag:lambda2icinga",
+    "Values": ["enabled", "True", "true"]
+}
+# Instances which are not terminated. Terminated instances are described
+# with their tags for about an hour after termination
+LIVE_INSTANCE_FILTER = {
+    "Name": "instance-state-name",
+    "Values": ["pending", "running", "stopping", "stopped"]
+}
+
+# Icinga2 objects generated for each host, in configuration file order,
+# mapped to EC2 tags selecting their template
+HOST_OBJECT_KINDS = ('endpoint', 'zone', 'host', 'service')
+TEMPLATE_TAGS = {
+    'endpoint': 'l2i_endpoint_template',
+    'zone': 'l2i_zone_template',
+    'host': 'l2i_host_template',
+    'service': 'l2i_service_template',
+}
+# Objects rendered once per (kind, template fingerprint, host fields) with
+# host fields replaced by placeholders, shared by hosts using the template
+RENDER_CACHE = OrderedDict()
+RENDER_CACHE_SIZE = int(environ.get('RENDER_CACHE_SIZE', 256))
+RENDER_CACHE_LOCK = threading.Lock()
+HOST_FIELD_PLACEHOLDER = '@@l2i:{0}@@'
+HOST_FIELD_PATTERN = re.compile('@@l2i:([A-Za-z0-9_]+)@@')
+
+# S3 templates cache, shared by every invocation handled by the same
+# Lambda container. Keyed by (bucket, key)
+TEMPLATE_CACHE = OrderedDict()
+TEMPLATE_CACHE_TTL = int(environ.get('TEMPLATE_CACHE_TTL', 300))
+TEMPLATE_CACHE_SIZE = int(environ.get('TEMPLATE_CACHE_SIZE', 64))
+TEMPLATE_CACHE_LOCK = threading.Lock()
+# Parsed templates schema: fields allowed for each object kind with their
+# expected value types
+SCALAR = (str, int, float, bool)
+OBJECT_FIELDS = {
+    'display_name': SCALAR,
+    'groups': list,
+    'vars': dict,
+    'check_command': SCALAR,
+    'max_check_attempts': SCALAR,
+    'check_period': SCALAR,
+    'check_timeout': SCALAR,
+    'check_interval': SCALAR,
+    'retry_interval': SCALAR,
+    'enable_notifications': SCALAR,
+    'enable_active_checks': SCALAR,
+    'enable_passive_checks': SCALAR,
+    'enable_event_handler': SCALAR,
+    'enable_flapping': SCALAR,
+    'enable_perfdata': SCALAR,
+    'event_command': SCALAR,
+    'flapping_threshold': SCALAR,
+    'volatile': SCALAR,
+    'zone': SCALAR,
+    'command_endpoint': SCALAR,
+    'notes': SCALAR,
+    'notes_url': SCALAR,
+    'action_url': SCALAR,
+    'icon_image': SCALAR,
+    'icon_image_alt': SCALAR,
+}
+SERVICE_FIELDS = dict(OBJECT_FIELDS,
+                      name=SCALAR,
+                      flapping_threshold_high=SCALAR,
+                      flapping_threshold_low=SCALAR)
+TEMPLATE_SCHEMAS = {
+    'endpoint': {'required': (),
+                 'fields': {'port': SCALAR, 'log_duration': SCALAR}},
+    'zone': {'required': (),
+             'fields': {'parent': SCALAR}},
+    'host': {'required': (),
+             'fields': OBJECT_FIELDS},
+    'service': {'required': ('name',),
+                'fields': SERVICE_FIELDS},
+}
+
+# AWS clients keyed by (service, region, role ARN), built once per container
+AWS_CLIENTS = {}
+# Guards lazy construction of shared clients from worker threads
+CLIENT_LOCK = threading.Lock()
+# Sessions of assumed roles keyed by role ARN, renewed ROLE_SESSION_MARGIN
+# seconds before their credentials expire
+ROLE_SESSIONS = {}
+ROLE_SESSION_LOCKS = {}
+ROLE_SESSION_NAME = 'lambda2icinga'
+ROLE_SESSION_MARGIN = 300
+
+# Icinga2 API HTTP session, shared by every invocation handled by the same
+# Lambda container
+API_SESSION = None
+API_POOL_SIZE = int(environ.get('API_POOL_SIZE', 10))
+API_TIMEOUT = (float(environ.get('API_CONNECT_TIMEOUT', 3.05)),
+               float(environ.get('API_READ_TIMEOUT', 30)))
+API_MAX_RETRIES = int(environ.get('API_MAX_RETRIES', 3))
+API_RETRY_BACKOFF = float(environ.get('API_RETRY_BACKOFF', 0.5))
+
+# Monitored instances state, mapping instance ID to last known host
+# metadata, package and uploaded (stage, digest). Snapshot is stored as
+# JSON object in STATE_BUCKET, reloaded once per invocation and updated
+# with changes recorded by provisioning. Recorded metadata is also the
+# hosts templates index, (object kind, template name) mapped back to
+# hostnames is built from it on first lookup
+INSTANCE_STATE_KEY = environ.get('INSTANCE_STATE_KEY',
+                                 'lambda2icinga/instance-state.json')
+INSTANCE_STATE_RETRIES = 3
+INSTANCE_STATE = {'instances': None,
+                  'reverse': None,
+                  'etag': None,
+                  'checked': False,
+                  'pending': {}}
+INSTANCE_STATE_LOCK = threading.RLock()
+
+# Icinga2 configuration packages mapped to their active stage, and to
+# every stage they hold, listed once per invocation
+PACKAGE_INDEX = None
+PACKAGE_STAGES = {}
+PACKAGE_INDEX_LOCK = threading.Lock()
+# Seconds stage uploaded to a shared package may stay inactive before it
+# is considered failed, until then next stages are built on top of it
+STAGE_VALIDATION_TIMEOUT = int(environ.get('STAGE_VALIDATION_TIMEOUT', 300))
+
+# Hosts configuration SHA-256 digests mapped by hostname to
+# (stage, digest), used to skip uploading unchanged configuration
+STAGE_HASHES = {}
+# Per invocation metrics: counters and recorded values (timings, sizes)
+# mapped by name with their unit, flushed as CloudWatch Embedded Metric
+# Format once invocation ends
+METRICS_NAMESPACE = environ.get('METRICS_NAMESPACE', 'lambda2icinga')
+METRICS = {'counters': {}, 'values': {}}
+METRICS_LOCK = threading.Lock()
+# Maximum number of values of single metric per EMF document
+METRICS_MAX_VALUES = 100
+
+# Fleet package mode: every host is stored as file of the single
+# FLEET_PACKAGE package, changed hosts are uploaded in batches
+FLEET_PACKAGE = environ.get('FLEET_PACKAGE')
+FLEET_BATCH_SIZE = int(environ.get('FLEET_BATCH_SIZE', 500))
+FLEET_FLUSH_INTERVAL = float(environ.get('FLEET_FLUSH_INTERVAL', 30))
+# Hosts configuration files queued for upload, None removes the file
+FLEET_QUEUE = {}
+FLEET_QUEUE_SINCE = None
+FLEET_LOCK = threading.RLock()
+# Files of the fleet package active (or last uploaded) stage, shared by
+# every invocation handled by the same Lambda container
+FLEET_FILES = {'stage': None, 'files': {}, 'lineage': []}
+
+# Shared services mode: every service template is rendered once into
+# SERVICE_APPLY_PACKAGE as Icinga2 templates and apply rules assigned by
+# host.vars.l2i_service_template, host packages carry only that marker
+SERVICE_APPLY_PACKAGE = environ.get('SERVICE_APPLY_PACKAGE')
+# Files of the services package active (or last uploaded) stage and
+# (stage, template fingerprint) of each file known to be up to date
+SERVICE_RULES = {'stage': None, 'files': {}, 'lineage': [], 'synced': {}}
+SERVICE_RULES_LOCK = threading.RLock()
+
+# Package deletions are spread to at most TEARDOWN_RATE requests per second
+# across all workers (0 disables the limit)
+TEARDOWN_RATE = float(environ.get('TEARDOWN_RATE', 20))
+TEARDOWN_NEXT = 0.0
+TEARDOWN_LOCK = threading.Lock()
+
+# Newly monitored hosts checks are downtimed for NEW_HOST_DOWNTIME minutes,
+# at most DOWNTIME_CHUNK_SIZE hosts per schedule-downtime request
+NEW_HOST_DOWNTIME = int(environ.get('NEW_HOST_DOWNTIME', 15))
+DOWNTIME_CHUNK_SIZE = int(environ.get('DOWNTIME_CHUNK_SIZE', 100))
+
+# Hosts are provisioned across bounded worker pool. No new hosts are
+# scheduled once invocation has less than PROVISION_DEADLINE_MARGIN ms left
+PROVISION_CONCURRENCY = int(environ.get('PROVISION_CONCURRENCY', 8))
+PROVISION_DEADLINE_MARGIN = int(environ.get('PROVISION_DEADLINE_MARGIN', 10000))
+
+
+def get_instance_metadata(instance):
+    """
+        Build host metadata from EC2 instance description
+    """
+    metadata = {}
+    metadata['instance_id'] = instance['InstanceId']
+    # Set default host/service configuration templates
+    metadata['l2i_host_template'] = 'default'
+    metadata['l2i_service_template'] = 'default'
+    metadata['l2i_endpoint_template'] = 'default'
+    metadata['l2i_zone_template'] = 'default'
+    # Assign private ip (terminated instances have none)
+    metadata['address'] = instance.get('PrivateIpAddress')
+    for tag in instance.get('Tags', []):
+        # Get hostname
+        if tag['Key'] == 'Name':
+            metadata['hostname'] = tag['Value']
+        # Get host configuration template
+        if tag['Key'] == 'l2i_host_template':
+            metadata['l2i_host_template'] = tag['Value']
+        # Get service configuration template
+        if tag['Key'] == 'l2i_service_template':
+            metadata['l2i_service_template'] = tag['Value']
+        # Get host configuration template
+        if tag['Key'] == 'l2i_endpoint_template':
+            metadata['l2i_endpoint_template'] = tag['Value']
+        # Get service configuration template
+        if tag['Key'] == 'l2i_zone_template':
+            metadata['l2i_zone_template'] = tag['Value']
+        # Check if instance marked to be configured with public endpoint
+        # Example: ELB/ALB endpoints, Route53 entry, EC2 public dns name
+        if tag['Key'] == 'l2i_public_endpoint':
+            metadata['address'] = tag['Value']
+    return metadata
 
 
-def get_instance_data(ec2_filter):
+def get_instance_data(ec2_filter, targets=None):
     """
-        Get EC2 instances accross region
+        Get EC2 instances accross regions and accounts.
+        Generator yielding metadata of every matching instance as
+        describe_instances result pages arrive
+        Parameters:
+            - targets: (role ARN, region) pairs to describe, defaults to
+                       every discovery target
+    """
+    targets = targets or get_discovery_targets()
+    if len(targets) == 1:
+        pages = describe_instance_pages(ec2_filter, *targets[0])
+    else:
+        pages = describe_concurrently(ec2_filter, targets)
+    for page in pages:
+        for metadata in page:
+            yield metadata
+
+
+def get_discovery_targets():
+    """
+        Return (role ARN, region) pairs instances are discovered in,
+        role ARN is None for the Lambda account
+    """
+    regions = DISCOVERY_REGIONS or [environ.get('AWS_DEFAULT_REGION')]
+    return [(role_arn, region)
+            for role_arn in [None] + DISCOVERY_ROLE_ARNS
+            for region in regions]
+
+
+def get_event_target(event):
+    """
+        Return (role ARN, region) pair EC2 instances of the EventBridge
+        event are described in, None when event does not tell its region.
+        Accounts without discovery role are described with the Lambda
+        credentials
+    """
+    region = event.get('region')
+    if region is None:
+        return None
+    for role_arn in DISCOVERY_ROLE_ARNS:
+        if role_arn.split(':')[4:5] == [event.get('account')]:
+            return (role_arn, region)
+    return (None, region)
+
+
+def describe_instance_pages(ec2_filter, role_arn, region):
+    """
+        Describe EC2 instances of one account and region. Generator
+        yielding list of instances metadata per describe_instances page,
+        tagged with instance region and account
+    """
+    ec2 = get_aws_client('ec2', region, role_arn)
+    paginator = ec2.get_paginator('describe_instances')
+    pages = iter(paginator.paginate(Filters=ec2_filter,
+                                    PaginationConfig={'PageSize': DESCRIBE_PAGE_SIZE}))
+    while True:
+        with timed('discovery.describe_instances'):
+            page = next(pages, None)
+        if page is None:
+            break
+        hosts = []
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                metadata = get_instance_metadata(instance)
+                if 'hostname' not in metadata:
+                    LOGGER.warning("Instance %s has no Name tag. Skipping...",
+                                   metadata['instance_id'])
+                    continue
+                metadata['region'] = region
+                metadata['account'] = reservation.get('OwnerId')
+                LOGGER.debug("Instance: %s", LogPayload(metadata))
+                hosts.append(metadata)
+        yield hosts
+
+
+def describe_concurrently(ec2_filter, targets):
     """
-    # Get EC2 resource
-    ec2 = boto3.client('ec2', region_name=environ['AWS_DEFAULT_REGION'])
-    response = ec2.describe_instances(Filters=ec2_filter)
-    LOGGER.info(response)
+        Describe EC2 instances of every (role ARN, region) target across
+        bounded worker pool. Generator yielding pages as they arrive from
+        any target, so discovery takes as long as the slowest target.
+        Failure of any target is raised, as partial discovery would make
+        its instances look terminated
+    """
+    pages = queue.Queue()
+    stopped = threading.Event()
+
+    def describe(role_arn, region):
+        try:
+            for page in describe_instance_pages(ec2_filter, role_arn, region):
+                if stopped.is_set():
+                    break
+                pages.put(page)
+        except Exception as error:
+            LOGGER.error("Unable to describe instances in %s (%s): %s",
+                         region, role_arn or 'lambda account', error)
+            pages.put(error)
+        finally:
+            pages.put(None)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(DISCOVERY_CONCURRENCY,
+                                                         len(targets))))
     try:
-        #data = response['Reservations'][0]['Instances'][0]
-        reservations = response['Reservations']
-    except IndexError:
-        err_msg = "Unable to retrieve instance data. Aborting..."
-        LOGGER.error(err_msg)
-        sys.exit(1)
-    data = []
-    for reservation in reservations:
-        # Flag to configure instance with public ip
-        metadata = {}
-        # Set default host/service configuration templates
-        metadata['l2i_host_template'] = 'default'
-        metadata['l2i_service_template'] = 'default'
-        metadata['l2i_endpoint_template'] = 'default'
-        metadata['l2i_zone_template'] = 'default'
-        # Assign private ip
-        metadata['address'] = reservation['Instances'][0]['PrivateIpAddress']
-        for tag in reservation['Instances'][0]['Tags']:
-            # Get hostname
-            if tag['Key'] == 'Name':
-                metadata['hostname'] = tag['Value']
-            # Get host configuration template
-            if tag['Key'] == 'l2i_host_template':
-                metadata['l2i_host_template'] = tag['Value']
-            # Get service configuration template
-            if tag['Key'] == 'l2i_service_template':
-                metadata['l2i_service_template'] = tag['Value']
-            # Get host configuration template
-            if tag['Key'] == 'l2i_endpoint_template':
-                metadata['l2i_endpoint_template'] = tag['Value']
-            # Get service configuration template
-            if tag['Key'] == 'l2i_zone_template':
-                metadata['l2i_zone_template'] = tag['Value']
-            # Check if instance marked to be configured with public endpoint
-            # Example: ELB/ALB endpoints, Route53 entry, EC2 public dns name
-            if tag['Key'] == 'l2i_public_endpoint':
-                metadata['address'] = tag['Value']
-        data.append(metadata)
-    LOGGER.info(data)
-    return data
+        for role_arn, region in targets:
+            executor.submit(describe, role_arn, region)
+        pending = len(targets)
+        while pending:
+            page = pages.get()
+            if page is None:
+                pending -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
 
 
-def get_conf_template(bucket, key):
+def get_role_session(role_arn):
+    """
+        Return boto3 session of the assumed role, shared by every
+        invocation until its credentials are about to expire
+    """
+    with CLIENT_LOCK:
+        role_lock = ROLE_SESSION_LOCKS.setdefault(role_arn, threading.Lock())
+    with role_lock:
+        entry = ROLE_SESSIONS.get(role_arn)
+        if entry is not None and \
+                entry['expiration'] - time.time() > ROLE_SESSION_MARGIN:
+            return entry['session']
+        sts = get_aws_client('sts', environ.get('AWS_DEFAULT_REGION'))
+        with timed('discovery.assume_role'):
+            credentials = sts.assume_role(RoleArn=role_arn,
+                                          RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        session = boto3.session.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                        aws_secret_access_key=credentials['SecretAccessKey'],
+                                        aws_session_token=credentials['SessionToken'])
+        with CLIENT_LOCK:
+            # Clients of the previous session hold expiring credentials
+            for client_key in [client_key for client_key in AWS_CLIENTS
+                               if client_key[2] == role_arn]:
+                del AWS_CLIENTS[client_key]
+        ROLE_SESSIONS[role_arn] = {
+            'session': session,
+            'expiration': calendar.timegm(credentials['Expiration'].utctimetuple())}
+        LOGGER.info("Assumed role %s", role_arn)
+        return session
+
+
+def get_aws_client(service_name, region_name=None, role_arn=None):
+    """
+        Return AWS service client shared by every invocation handled by
+        the same Lambda container. Clients of role_arn use credentials of
+        the assumed role
+    """
+    session = boto3 if role_arn is None else get_role_session(role_arn)
+    client_key = (service_name, region_name, role_arn)
+    try:
+        return AWS_CLIENTS[client_key]
+    except KeyError:
+        pass
+    with CLIENT_LOCK:
+        if client_key not in AWS_CLIENTS:
+            AWS_CLIENTS[client_key] = session.client(service_name,
+                                                     region_name=region_name)
+        return AWS_CLIENTS[client_key]
+
+
+def get_s3_client():
+    """
+        Return S3 client shared by every invocation
     """
-        Read S3 object and return its stored data
+    return get_aws_client('s3')
+
+
+def get_template_entry(bucket, key):
     """
-    client = boto3.client('s3')
+        Read S3 object and return its cache entry: stored data ('body',
+        None when object does not exist), parsed data and fingerprint are
+        all read from the returned entry, so they belong to the same
+        object version. Object is cached and revalidated using its ETag once cache
+        entry is older than TEMPLATE_CACHE_TTL. Cached object is kept when
+        revalidation fails, other S3 errors are raised
+    """
+    cache_key = (bucket, key)
+    now = time.time()
+    with TEMPLATE_CACHE_LOCK:
+        entry = TEMPLATE_CACHE.get(cache_key)
+        if entry is not None and now - entry['checked'] < TEMPLATE_CACHE_TTL:
+            TEMPLATE_CACHE.move_to_end(cache_key)
+            count_metric('templates.cache_hit')
+            return entry
+    count_metric('templates.cache_miss')
+    params = {'Bucket': bucket, 'Key': key}
+    if entry is not None and entry['etag'] is not None:
+        params['IfNoneMatch'] = entry['etag']
     try:
-        obj = client.get_object(Bucket=bucket, Key=key)
-        return obj['Body'].read()
+        with timed('templates.fetch'):
+            obj = get_s3_client().get_object(**params)
     except ClientError as err:
-        if err.response['Error']['Code'] == "NoSuchKey":
-            # Log missing template 'fallback' operation
-            LOGGER.warning("Can not find template: \n{0}".format(key))
+        code = err.response['Error']['Code']
+        if entry is not None and code in ('304', 'NotModified'):
+            # Cached template is still up to date
+            count_metric('templates.revalidated')
+            with TEMPLATE_CACHE_LOCK:
+                entry['checked'] = now
+                if cache_key in TEMPLATE_CACHE:
+                    TEMPLATE_CACHE.move_to_end(cache_key)
+            return entry
+        if code != "NoSuchKey":
+            # Throttling, permissions or S3 errors do not mean template was
+            # removed: serve cached template or fail hosts using it
+            if entry is None:
+                raise
+            LOGGER.warning("Unable to revalidate template %s (%s), using cached copy",
+                           key, code)
+            with TEMPLATE_CACHE_LOCK:
+                entry['checked'] = now
+            return entry
+        # Log missing template 'fallback' operation. Missing template is
+        # cached as well, so hosts using it do not look it up one by one
+        LOGGER.warning("Can not find template: \n{0}".format(key))
+        entry = {'body': None, 'etag': None, 'checked': now}
+    else:
+        entry = {'body': obj['Body'].read(),
+                 'etag': obj['ETag'],
+                 'checked': now}
+    with TEMPLATE_CACHE_LOCK:
+        TEMPLATE_CACHE[cache_key] = entry
+        TEMPLATE_CACHE.move_to_end(cache_key)
+        while len(TEMPLATE_CACHE) > TEMPLATE_CACHE_SIZE:
+            TEMPLATE_CACHE.popitem(last=False)
+    return entry
 
 
-def generate_apiuser_configuration(template):
+def get_conf_template(bucket, key):
     """
-    Generates Icinga2 ApiUser object, which is used for authentication against
-    the Icinga 2 API
-    ApiUser object params:
-    - password: Password string
-    - client_cn: Client Common Name
-    - permissions: Array of permissions
+        Read S3 object and return its stored data, None when it does not
+        exist
+    """
+    return get_template_entry(bucket, key)['body']
+
+
+def validate_template(kind, data):
+    """
+        Validate parsed template against its object kind schema.
+        Returns list of errors, unknown fields are only reported as warnings
+    """
+    schema = TEMPLATE_SCHEMAS[kind]
+    if kind == 'service':
+        if not isinstance(data, list):
+            return ["service template must be a list of services"]
+        objects = data
+    else:
+        if not isinstance(data, dict):
+            return ["{0} template must be a mapping".format(kind)]
+        objects = [data]
+    errors = []
+    for position, obj in enumerate(objects):
+        if not isinstance(obj, dict):
+            errors.append("{0} #{1} must be a mapping".format(kind, position))
+            continue
+        for field in schema['required']:
+            if field not in obj:
+                errors.append("{0} #{1} is missing '{2}'".format(kind,
+                                                                 position,
+                                                                 field))
+        for field, value in obj.items():
+            expected = schema['fields'].get(field)
+            if expected is None:
+                LOGGER.warning("Unknown %s template field: %s", kind, field)
+            elif not isinstance(value, expected):
+                errors.append("{0} #{1} field '{2}' has invalid type".format(kind,
+                                                                             position,
+                                                                             field))
+    return errors
+
+
+def parse_template(key, body):
+    """
+        Parse YAML template using libyaml when available and validate it
+        against schema of its object kind. Raises ValueError for invalid
+        template, so hosts using it keep their deployed configuration
+    """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    try:
+        data = yaml.load(body, Loader=loader)
+    except yaml.YAMLError as err:
+        LOGGER.error("Unable to parse template %s: %s", key, err)
+        raise ValueError("Unable to parse template {0}".format(key))
+    kind = key.partition('/')[0]
+    if kind not in TEMPLATE_SCHEMAS:
+        return data
+    if data is None:
+        # Empty template, use object defaults
+        data = [] if kind == 'service' else {}
+    errors = validate_template(kind, data)
+    if errors:
+        LOGGER.error("Invalid template %s: %s", key, '; '.join(errors))
+        raise ValueError("Invalid template {0}".format(key))
+    return data
+
+
+def get_template(bucket, key):
+    """
+        Return (parsed YAML content, SHA-256 fingerprint) of the S3 stored
+        template, (None, None) when it does not exist. Template is parsed
+        once and cached alongside the raw template data, as is the error
+        of invalid template
+    """
+    entry = get_template_entry(bucket, key)
+    if entry['body'] is None:
+        return None, None
+    if 'parsed' not in entry and 'error' not in entry:
+        try:
+            entry['parsed'] = parse_template(key, entry['body'])
+        except ValueError as err:
+            entry['error'] = err
+    if 'error' in entry:
+        raise entry['error']
+    if 'fingerprint' not in entry:
+        entry['fingerprint'] = hashlib.sha256(entry['body']).hexdigest()
+    return entry['parsed'], entry['fingerprint']
+
+
+def invalidate_conf_template(bucket, key):
+    """
+        Drop cached template, so next read fetches it from S3
     """
-    conf = """
+    with TEMPLATE_CACHE_LOCK:
+        entry = TEMPLATE_CACHE.pop((bucket, key), None)
+    if entry is not None:
+        LOGGER.info("Template cache invalidated for: %s", key)
+
+
+APIUSER_CONF = """
     object ApiUser "{{ template.name }}" {
         {% if template.password is defined %}
         password = "{{ template.password }}"
@@ -117,28 +756,21 @@ def generate_apiuser_configuration(template):
         {% endif %}
     }
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(template=template)
 
 
-def generate_checkcommand_configuration(template):
+def generate_apiuser_configuration(template):
     """
-    Generates a check command object definition.
-    CheckCommand object params:
-    - command: The command. This can either be an array of individual command
-               arguments.Alternatively a string can be specified in which case
-               the shell interpreter (usually /bin/sh) takes care of parsing
-               the command. When using the “arguments” attribute this must be
-               an array. Can be specified as function for advanced
-               implementations.
-    - env: A dictionary of macros which should be exported as environment
-           variables prior to executing the command.
-    - vars: A dictionary containing custom attributes that are specific to
-            this command.
-    - timeout: The command timeout in seconds.
-    - arguments: A dictionary of command arguments.
+    Generates Icinga2 ApiUser object, which is used for authentication against
+    the Icinga 2 API
+    ApiUser object params:
+    - password: Password string
+    - client_cn: Client Common Name
+    - permissions: Array of permissions
     """
-    conf = """
+    return get_object_template('apiuser').render(template=template)
+
+
+CHECKCOMMAND_CONF = """
     object CheckCommand "{{ template.name }}" {
         command = [ {{ template.command }} ]
         {% if template.env is defined %}
@@ -171,27 +803,29 @@ def generate_checkcommand_configuration(template):
         {% endif %}
     }
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(template=template)
 
 
-def generate_comment_configuration(template):
+def generate_checkcommand_configuration(template):
     """
-    Comments created at runtime are represented as objects
+    Generates a check command object definition.
     CheckCommand object params:
-    - host_name: The name of the host this comment belongs to
-    - service_name: The short name of the service this comment belongs to.
-    - author: The author’s name.
-    - text: The comment text.
-    - entry_time: The UNIX timestamp when this comment was added.
-    - entry_type: The comment type
-                  (User = 1, Downtime = 2, Flapping = 3, Acknowledgement = 4)
-    - expire_time: The comment’s expire time as UNIX timestamp
-    - persistent: Only evaluated for entry_type Acknowledgement.
-                  true does not remove the comment when the acknowledgement
-                  is removed.
+    - command: The command. This can either be an array of individual command
+               arguments.Alternatively a string can be specified in which case
+               the shell interpreter (usually /bin/sh) takes care of parsing
+               the command. When using the “arguments” attribute this must be
+               an array. Can be specified as function for advanced
+               implementations.
+    - env: A dictionary of macros which should be exported as environment
+           variables prior to executing the command.
+    - vars: A dictionary containing custom attributes that are specific to
+            this command.
+    - timeout: The command timeout in seconds.
+    - arguments: A dictionary of command arguments.
     """
-    conf = """
+    return get_object_template('checkcommand').render(template=template)
+
+
+COMMENT_CONF = """
     object Comment "{{ template.name }}" {
     host_name = {{ template.host_name }}
     {% if template.service_name is defined %}
@@ -213,34 +847,28 @@ def generate_comment_configuration(template):
     {% endif %}
     }
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(template=template)
 
 
-def generate_dependency_configuration(template):
+def generate_comment_configuration(template):
     """
-    Generates Dependency objects are used to specify dependencies between
-    hosts and services. Dependencies can be defined as:
-        Host-to-Host,
-        Service-to-Service,
-        Service-to-Host,
-        Host-to-Service relations.
-    Dependency object params:
-    - parent_host_name: The parent host.
-    - parent_service_name: The parent service. If omitted, this
-                           dependency object is treated as host dependency.
-    - child_host_name: The child host.
-    - child_service_name: The child service. If omitted, this
-                          dependency object is treated as host dependency.
-    - disable_checks: Whether to disable checks when this dependency fails.
-    - disable_notifications: Whether to disable notifications when this
-                             dependency fails.
-    - ignore_soft_states: Whether to ignore soft states for the reachability
-                          calculation.
-    - period: Time period object during which this dependency is enabled.
-    - states: A list of state filters when this dependency should be OK.
+    Comments created at runtime are represented as objects
+    CheckCommand object params:
+    - host_name: The name of the host this comment belongs to
+    - service_name: The short name of the service this comment belongs to.
+    - author: The author’s name.
+    - text: The comment text.
+    - entry_time: The UNIX timestamp when this comment was added.
+    - entry_type: The comment type
+                  (User = 1, Downtime = 2, Flapping = 3, Acknowledgement = 4)
+    - expire_time: The comment’s expire time as UNIX timestamp
+    - persistent: Only evaluated for entry_type Acknowledgement.
+                  true does not remove the comment when the acknowledgement
+                  is removed.
     """
-    conf = """
+    return get_object_template('comment').render(template=template)
+
+
+DEPENDENCY_CONF = """
     object Dependency "{{ template.name }}" {
     parent_host_name = "{{ template.parent_host_name }}"
     {% if template.parent_service_name is defined %}
@@ -267,21 +895,35 @@ def generate_dependency_configuration(template):
     {% endif %}
     }
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(template=template)
 
 
-def generate_endpoint_configuration(data, template):
+def generate_dependency_configuration(template):
     """
-    Generates Icinga2 endpoint configuration from the template
-    Endpoint object params:
-    - host: The hostname/IP address of the remote Icinga 2 instance
-    - port: The service name/port of the remote Icinga 2 instance
-    - log_duration: Duration for keeping replay logs on connection loss.
-    Defaults to 1d (86400 seconds). Attribute is specified in seconds.
-    If log_duration is set to 0, replaying logs is disabled.
+    Generates Dependency objects are used to specify dependencies between
+    hosts and services. Dependencies can be defined as:
+        Host-to-Host,
+        Service-to-Service,
+        Service-to-Host,
+        Host-to-Service relations.
+    Dependency object params:
+    - parent_host_name: The parent host.
+    - parent_service_name: The parent service. If omitted, this
+                           dependency object is treated as host dependency.
+    - child_host_name: The child host.
+    - child_service_name: The child service. If omitted, this
+                          dependency object is treated as host dependency.
+    - disable_checks: Whether to disable checks when this dependency fails.
+    - disable_notifications: Whether to disable notifications when this
+                             dependency fails.
+    - ignore_soft_states: Whether to ignore soft states for the reachability
+                          calculation.
+    - period: Time period object during which this dependency is enabled.
+    - states: A list of state filters when this dependency should be OK.
     """
-    conf = """
+    return get_object_template('dependency').render(template=template)
+
+
+ENDPOINT_CONF = """
     object Endpoint "{{ data.hostname }}" {
         host = "{{ data.address }}"
         {% if template.port is defined %}
@@ -292,76 +934,45 @@ def generate_endpoint_configuration(data, template):
         {% endif %}
     }
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(data=data,
-                                                                    template=template)
 
 
-def generate_zone_configuration(data, template):
+def generate_endpoint_configuration(data, template):
     """
-    Generates Icinga2 zone configuration from the template
-    Zone objects are used to specify which Icinga 2 instances are located in a zone.
-    Zone object params:
-    - endpoints: Array of endpoint names located in this zone
-    - parent: The name of the parent zone
+    Generates Icinga2 endpoint configuration from the template
+    Endpoint object params:
+    - host: The hostname/IP address of the remote Icinga 2 instance
+    - port: The service name/port of the remote Icinga 2 instance
+    - log_duration: Duration for keeping replay logs on connection loss.
+    Defaults to 1d (86400 seconds). Attribute is specified in seconds.
+    If log_duration is set to 0, replaying logs is disabled.
     """
-    conf = """
+    return get_object_template('endpoint').render(data=data, template=template)
+
+
+ZONE_CONF = """
     object Zone "{{ data.hostname }}" {
         endpoints = [ "{{ data.hostname }}" ]
         {% if template.parent is defined %}
         parent = "{{ template.parent }}"
-        {% elif %}
+        {% else %}
         parent = "master"
         {% endif %}
     }
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(data=data,
-                                                                    template=template)
 
 
-def generate_host_configuration(data, template):
+def generate_zone_configuration(data, template):
     """
-    Genearates Icinga2 host configuration from the template
-    Host object params:
-    - display_name: A short description of the host
-    - address: The host’s address.
-    - groups: A list of host groups this host belongs to.
-    - vars: A dictionary containing custom attributes for this host.
-    - check_command: The name of the check command.
-    - max_check_attempts: The number of times a host is re-checked before
-    changing into a hard state.
-    - check_period: The name of a time period which determines when this host
-    should be checked. Not set by default.
-    - check_timeout: Check command timeout in seconds. Overrides the
-    CheckCommand’s timeout attribute.
-    - check_interval: The check interval (in seconds). This interval is used
-    for checks when the host is in a HARD state.
-    - retry_interval: The retry interval (in seconds). This interval is used
-    for checks when the host is in a SOFT state.
-    - enable_notifications: Whether notifications are enabled.
-    - enable_active_checks: Whether active checks are enabled.
-    - enable_passive_checks: Whether passive checks are enabled.
-    - enable_event_handler: Enables event handlers for this host.
-    - enable_flapping: Whether flap detection is enabled.
-    - enable_perfdata: Whether performance data processing is enabled.
-    - event_command: The name of an event command that should be executed every
-    time the host’s state changes or the host is in a SOFT state.
-    - flapping_threshold: The flapping threshold in percent when a host is
-    considered to be flapping.
-    - volatile: The volatile setting enables always HARD state types if NOT-OK
-    state changes occur.
-    - zone: The zone this object is a member of.
-    - command_endpoint: The endpoint where commands are executed on.
-    - notes: Notes for the host.
-    - notes_url: Url for notes for the host
-    - action_url: Url for actions for the host
-    - icon_image: Icon image for the host.
-    Used by external interfaces only.
-    - icon_image_alt Icon image description for the host.
-    Used by external interface only.
+    Generates Icinga2 zone configuration from the template
+    Zone objects are used to specify which Icinga 2 instances are located in a zone.
+    Zone object params:
+    - endpoints: Array of endpoint names located in this zone
+    - parent: The name of the parent zone
     """
-    conf = """
+    return get_object_template('zone').render(data=data, template=template)
+
+
+HOST_CONF = """
     object Host "{{ data.hostname }}" {
         address = "{{ data.address }}"
         {% if template.check_command is defined %}
@@ -441,60 +1052,71 @@ def generate_host_configuration(data, template):
         {% if template.icon_image_alt is defined %}
         icon_image_alt = "{{ template.icon_image_alt }}"
         {% endif %}
+        {% if service_apply %}
+        vars.l2i_service_template = "{{ data.l2i_service_template }}"
+        {% endif %}
     }
 
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(data=data,
-                                                                    template=template)
 
 
-def generate_service_configuration(data, template):
+def generate_host_configuration(data, template):
     """
-    Genearates Icinga2 service configuration from the template
-    Service object params:
-    - host_name: The host this service belongs to
-    - display_name: A short description of the service
-    - groups: The service groups this service belongs to
-    - vars: A dictionary containing custom attributes that are specific
-    to this service
-    - check_command: The name of the check command
-    - max_check_attempts: The number of times a service is re-checked
-    before changing into a hard state
-    - check_period: he name of a time period which determines when
-    this service should be checked
-    - check_timeout: Check command timeout in seconds
-    - check_interval: The check interval in seconds
-    - retry_interval: The retry interval in seconds
-    - enable_notifications: Whether notifications are enabled
-    - enable_active_checks: Whether active checks are enabled
-    - enable_passive_checks: Whether passive checks are enabled
-    - enable_event_handler: Enables event handlers for this host
-    - enable_flapping: Whether flap detection is enabled
-    - flapping_threshold_high: Flapping upper bound in percent for a
-    service to be considered flapping
-    - flapping_threshold_low: Flapping lower bound in percent for a
-    service to be considered not flapping.
-    - enable_perfdata: Whether performance data processing is enabled
-    - event_command: The name of an event command that should be executed
-    every time the service’s state changes or the service is in a SOFT state
+    Genearates Icinga2 host configuration from the template
+    Host object params:
+    - display_name: A short description of the host
+    - address: The host’s address.
+    - groups: A list of host groups this host belongs to.
+    - vars: A dictionary containing custom attributes for this host.
+    - check_command: The name of the check command.
+    - max_check_attempts: The number of times a host is re-checked before
+    changing into a hard state.
+    - check_period: The name of a time period which determines when this host
+    should be checked. Not set by default.
+    - check_timeout: Check command timeout in seconds. Overrides the
+    CheckCommand’s timeout attribute.
+    - check_interval: The check interval (in seconds). This interval is used
+    for checks when the host is in a HARD state.
+    - retry_interval: The retry interval (in seconds). This interval is used
+    for checks when the host is in a SOFT state.
+    - enable_notifications: Whether notifications are enabled.
+    - enable_active_checks: Whether active checks are enabled.
+    - enable_passive_checks: Whether passive checks are enabled.
+    - enable_event_handler: Enables event handlers for this host.
+    - enable_flapping: Whether flap detection is enabled.
+    - enable_perfdata: Whether performance data processing is enabled.
+    - event_command: The name of an event command that should be executed every
+    time the host’s state changes or the host is in a SOFT state.
+    - flapping_threshold: The flapping threshold in percent when a host is
+    considered to be flapping.
     - volatile: The volatile setting enables always HARD state types if NOT-OK
-    state changes occur
-    - zone: The zone this object is a member of
-    - command_endpoint: The endpoint where commands are executed on
-    - notes: Notes for the service
-    - notes_url: URL for notes for the service
-    - action_url: URL for actions for the service
-    - icon_image: Icon image for the service
-    - icon_image_alt: Icon image description for the service
+    state changes occur.
+    - zone: The zone this object is a member of.
+    - command_endpoint: The endpoint where commands are executed on.
+    - notes: Notes for the host.
+    - notes_url: Url for notes for the host
+    - action_url: Url for actions for the host
+    - icon_image: Icon image for the host.
+    Used by external interfaces only.
+    - icon_image_alt Icon image description for the host.
+    Used by external interface only.
     """
-    conf = """
+    return get_object_template('host').render(data=data,
+                                              template=template,
+                                              service_apply=bool(SERVICE_APPLY_PACKAGE))
+
+
+SERVICE_CONF = """
+    {% if apply is defined %}
+    template Service "l2i-{{ apply }}-{{ template.name }}" {
+    {% else %}
     object Service "{{ template.name }}" {
         host_name = "{{ data.hostname }}"
+    {% endif %}
         {% if template.display_name is defined %}
         display_name = "{{ template.display_name }}"
         {% endif %}
-        {% if template.groups in defined %}
+        {% if template.groups is defined %}
         groups = [{% for group in template.groups %}"{{ group }}",{% endfor %}]
         {% endif %}
         {% if template.max_check_attempts is defined %}
@@ -575,10 +1197,172 @@ def generate_service_configuration(data, template):
         icon_image_alt = "{{ template.icon_image_alt }}"
         {% endif %}
     }
+    {% if apply is defined %}
+    apply Service "{{ template.name }}" {
+        import "l2i-{{ apply }}-{{ template.name }}"
+        assign where host.vars.l2i_service_template == "{{ apply }}"
+    }
+    {% endif %}
+    """
+
+
+def generate_service_configuration(data, template):
+    """
+    Genearates Icinga2 service configuration from the template
+    Service object params:
+    - host_name: The host this service belongs to
+    - display_name: A short description of the service
+    - groups: The service groups this service belongs to
+    - vars: A dictionary containing custom attributes that are specific
+    to this service
+    - check_command: The name of the check command
+    - max_check_attempts: The number of times a service is re-checked
+    before changing into a hard state
+    - check_period: he name of a time period which determines when
+    this service should be checked
+    - check_timeout: Check command timeout in seconds
+    - check_interval: The check interval in seconds
+    - retry_interval: The retry interval in seconds
+    - enable_notifications: Whether notifications are enabled
+    - enable_active_checks: Whether active checks are enabled
+    - enable_passive_checks: Whether passive checks are enabled
+    - enable_event_handler: Enables event handlers for this host
+    - enable_flapping: Whether flap detection is enabled
+    - flapping_threshold_high: Flapping upper bound in percent for a
+    service to be considered flapping
+    - flapping_threshold_low: Flapping lower bound in percent for a
+    service to be considered not flapping.
+    - enable_perfdata: Whether performance data processing is enabled
+    - event_command: The name of an event command that should be executed
+    every time the service’s state changes or the service is in a SOFT state
+    - volatile: The volatile setting enables always HARD state types if NOT-OK
+    state changes occur
+    - zone: The zone this object is a member of
+    - command_endpoint: The endpoint where commands are executed on
+    - notes: Notes for the service
+    - notes_url: URL for notes for the service
+    - action_url: URL for actions for the service
+    - icon_image: Icon image for the service
+    - icon_image_alt: Icon image description for the service
     """
-    return Environment(trim_blocks=True,
-                       lstrip_blocks=True).from_string(conf).render(data=data,
-                                                                    template=template)
+    return get_object_template('service').render(data=data, template=template)
+
+
+# Icinga2 object templates sources, keyed by object kind
+OBJECT_TEMPLATES = {
+    'apiuser': APIUSER_CONF,
+    'checkcommand': CHECKCOMMAND_CONF,
+    'comment': COMMENT_CONF,
+    'dependency': DEPENDENCY_CONF,
+    'endpoint': ENDPOINT_CONF,
+    'zone': ZONE_CONF,
+    'host': HOST_CONF,
+    'service': SERVICE_CONF,
+}
+# Jinja environment and compiled object templates, shared by every
+# invocation handled by the same Lambda container
+JINJA_ENV = None
+COMPILED_TEMPLATES = {}
+
+
+def get_object_template(kind):
+    """
+        Return compiled Jinja template for the Icinga2 object kind.
+        Template is compiled on first use and reused afterwards.
+    """
+    global JINJA_ENV
+    try:
+        return COMPILED_TEMPLATES[kind]
+    except KeyError:
+        pass
+    if JINJA_ENV is None:
+        from jinja2 import Environment
+        JINJA_ENV = Environment(trim_blocks=True,
+                                lstrip_blocks=True)
+    compiled = JINJA_ENV.from_string(OBJECT_TEMPLATES[kind])
+    COMPILED_TEMPLATES[kind] = compiled
+    return compiled
+
+
+def render_many(kind, rows):
+    """
+        Render list of Icinga2 objects of the same kind in one pass
+        Parameters:
+            - kind: object kind (e.g. 'host', 'service')
+            - rows: list of render arguments, one dict per object
+                    (e.g. {'data': metadata, 'template': service})
+    """
+    compiled = get_object_template(kind)
+    return ''.join(compiled.render(**row) for row in rows)
+
+
+class ApiRetry(Retry):
+    """
+        Retry policy of Icinga2 API requests. Idempotent requests are
+        retried on connection, read and server errors. POST requests (stage
+        uploads, downtimes) may have been processed already, so they are
+        retried only on connection errors and when the master refused them
+    """
+    POST_RETRY_STATUSES = frozenset([429, 503])
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == 'POST':
+            return status_code in self.POST_RETRY_STATUSES
+        return super(ApiRetry, self).is_retry(method,
+                                              status_code,
+                                              has_retry_after)
+
+
+def get_api_session():
+    """
+        Return pooled HTTP session used for Icinga2 API requests.
+        Session keeps connections to Icinga2 master alive between requests
+        and retries failed requests with exponential backoff
+    """
+    global API_SESSION
+    with CLIENT_LOCK:
+        if API_SESSION is not None:
+            return API_SESSION
+        retry_params = {'total': API_MAX_RETRIES,
+                        'backoff_factor': API_RETRY_BACKOFF,
+                        'status_forcelist': (429, 500, 502, 503, 504),
+                        'raise_on_status': False}
+        # POST is not listed, so its read errors are never retried
+        methods = frozenset(['GET', 'DELETE'])
+        try:
+            retries = ApiRetry(allowed_methods=methods, **retry_params)
+        except TypeError:
+            # urllib3 < 1.26
+            retries = ApiRetry(method_whitelist=methods, **retry_params)
+        adapter = HTTPAdapter(pool_connections=API_POOL_SIZE,
+                              pool_maxsize=API_POOL_SIZE,
+                              max_retries=retries)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        API_SESSION = session
+    return API_SESSION
+
+
+def read_api_response(url, response):
+    """
+        Return decoded JSON body of successful Icinga2 API response.
+        Error responses (left after retries) and bodies which are not JSON
+        are logged and None is returned
+    """
+    if not response.ok:
+        LOGGER.error("Request to %s failed: HTTP %s %s",
+                     url,
+                     response.status_code,
+                     LogPayload(response.text))
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        LOGGER.error("Request to %s returned invalid JSON: %s",
+                     url,
+                     LogPayload(response.text))
+        return None
 
 
 def get_api_request(url,
@@ -596,26 +1380,54 @@ def get_api_request(url,
         LOGGER.error("FAIL: Icinga2 user is missing")
     else:
         try:
-            response = requests.get(str(url),
-                                    auth=(str(user),
-                                          str(password)),
-                                    verify=ssl_verify)
+            response = get_api_session().get(str(url),
+                                             auth=(str(user),
+                                                   str(password)),
+                                             timeout=API_TIMEOUT,
+                                             verify=ssl_verify)
         except requests.exceptions.Timeout:
             LOGGER.error("Request to %s has timed out.", url)
-            # Maybe set up for a retry, or continue in a retry loop
+            return None
         except requests.exceptions.TooManyRedirects:
             LOGGER.error("Request to %s results in too many redirects.", url)
-        # Tell the user their URL was bad and try a different one
+            return None
+        # Connection failures left after retries fail the request only,
+        # callers decide whether host or invocation fails
         except requests.exceptions.RequestException as err:
-            # catastrophic error. bail.
-            LOGGER.error(err)
-            sys.exit(1)
-        response_data = response.json()
-        results = response_data['results']
-        LOGGER.info(results)
+            LOGGER.error("Request to %s failed: %s", url, err)
+            return None
+        response_data = read_api_response(url, response)
+        if response_data is None:
+            return None
+        results = response_data.get('results')
+        LOGGER.debug("URI: %s %s", url, LogPayload(results))
         return results
 
 
+def get_api_file(url,
+                 user,
+                 password,
+                 ssl_verify=False):
+    """
+        Download (GET) configuration file content from Icinga2 master
+    """
+    headers = {'Accept': 'application/octet-stream'}
+    try:
+        response = get_api_session().get(str(url),
+                                         auth=(str(user),
+                                               str(password)),
+                                         headers=headers,
+                                         timeout=API_TIMEOUT,
+                                         verify=ssl_verify)
+    except requests.exceptions.RequestException as err:
+        LOGGER.error("Request to %s failed: %s", url, err)
+        return None
+    if response.status_code != 200:
+        LOGGER.warning("Unable to download %s: HTTP %s", url, response.status_code)
+        return None
+    return response.content
+
+
 def post_api_request(url,
                      user,
                      password,
@@ -634,29 +1446,26 @@ def post_api_request(url,
         LOGGER.error("FAIL: Icinga2 user is missing")
     else:
         try:
-            if data is None:
-                response = requests.post(url,
-                                         auth=(user, password),
-                                         headers=headers,
-                                         verify=ssl_verify)
-            else:
-                response = requests.post(url,
-                                         auth=(user, password),
-                                         headers=headers,
-                                         data=data,
-                                         verify=ssl_verify)
+            response = get_api_session().post(url,
+                                              auth=(user, password),
+                                              headers=headers,
+                                              data=data,
+                                              timeout=API_TIMEOUT,
+                                              verify=ssl_verify)
         except requests.exceptions.Timeout:
             LOGGER.error("Request to %s has timed out.", url)
-        # Maybe set up for a retry, or continue in a retry loop
+            return None
         except requests.exceptions.TooManyRedirects:
             LOGGER.error("Request to %s results in too many redirects.", url)
-        # Tell the user their URL was bad and try a different one
+            return None
+        # Connection failures left after retries fail the request only,
+        # callers decide whether host or invocation fails
         except requests.exceptions.RequestException as err:
-            # catastrophic error. bail.
-            LOGGER.error(err)
-            sys.exit(1)
-        response_data = response.json()
-        LOGGER.info("URI: %s \n%s", url, response_data)
+            LOGGER.error("Request to %s failed: %s", url, err)
+            return None
+        response_data = read_api_response(url, response)
+        LOGGER.debug("URI: %s %s", url, LogPayload(response_data))
+        return response_data
 
 
 def delete_api_request(url,
@@ -674,23 +1483,618 @@ def delete_api_request(url,
         LOGGER.error("FAIL: Icinga2 user is missing")
     else:
         try:
-            response = requests.delete(str(url),
-                                       auth=(str(user),
-                                             str(password)),
-                                       verify=ssl_verify)
+            response = get_api_session().delete(str(url),
+                                                auth=(str(user),
+                                                      str(password)),
+                                                timeout=API_TIMEOUT,
+                                                verify=ssl_verify)
         except requests.exceptions.Timeout:
             LOGGER.error("Request to %s has timed out.", url)
-            # Maybe set up for a retry, or continue in a retry loop
+            return None
         except requests.exceptions.TooManyRedirects:
             LOGGER.error("Request to %s results in too many redirects.", url)
-        # Tell the user their URL was bad and try a different one
+            return None
+        # Connection failures left after retries fail the request only,
+        # callers decide whether host or invocation fails
         except requests.exceptions.RequestException as err:
-            # catastrophic error. bail.
-            LOGGER.error(err)
-            sys.exit(1)
-        response_data = response.json()
-        results = response_data['results']
-        LOGGER.info(results)
+            LOGGER.error("Request to %s failed: %s", url, err)
+            return None
+        response_data = read_api_response(url, response)
+        if response_data is None:
+            return None
+        results = response_data.get('results')
+        LOGGER.debug("URI: %s %s", url, LogPayload(results))
+        return results
+
+
+def get_package_index(api_endpoint,
+                      api_port,
+                      api_user,
+                      api_pass):
+    """
+        Return Icinga2 configuration package names mapped to their active
+        stage. Packages are listed once per invocation, afterwards the
+        index is kept up to date as packages are created or deleted
+    """
+    global PACKAGE_INDEX, PACKAGE_STAGES
+    with PACKAGE_INDEX_LOCK:
+        if PACKAGE_INDEX is None:
+            pkg_base_url = "https://{0}:{1}/v1/config/packages".format(api_endpoint,
+                                                                       api_port)
+            packages = get_api_request(pkg_base_url, api_user, api_pass)
+            if packages is None:
+                # Do not remember failed listing, retry on next lookup
+                return {}
+            PACKAGE_INDEX = dict((package['name'], package.get('active-stage'))
+                                 for package in packages)
+            PACKAGE_STAGES = dict((package['name'], set(package.get('stages') or []))
+                                  for package in packages)
+        return PACKAGE_INDEX
+
+
+def read_state_object(bucket, key, etag=None):
+    """
+        Read JSON state object from S3.
+        Returns (data, etag) tuple, data is None when object is missing
+        and etag is unchanged when object was not modified since etag
+    """
+    params = {'Bucket': bucket, 'Key': key}
+    if etag is not None:
+        params['IfNoneMatch'] = etag
+    try:
+        obj = get_s3_client().get_object(**params)
+    except ClientError as err:
+        code = err.response['Error']['Code']
+        if code in ('304', 'NotModified'):
+            return None, etag
+        if code == 'NoSuchKey':
+            return None, None
+        raise
+    return json.loads(obj['Body'].read().decode('utf-8')), obj['ETag']
+
+
+def write_state_object(bucket, key, data, etag=None):
+    """
+        Write JSON state object to S3, only if it was not changed since
+        it has been read with etag (or still does not exist when etag is
+        None). Returns new object etag or None when object was changed
+        concurrently
+    """
+    params = {'Bucket': bucket,
+              'Key': key,
+              'Body': json.dumps(data, sort_keys=True).encode('utf-8'),
+              'ContentType': 'application/json'}
+    if etag is None:
+        params['IfNoneMatch'] = '*'
+    else:
+        params['IfMatch'] = etag
+    try:
+        return get_s3_client().put_object(**params)['ETag']
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('PreconditionFailed',
+                                             'ConditionalRequestConflict',
+                                             '412', '409'):
+            return None
+        raise
+
+
+def scan_template_hosts(kind, template_name):
+    """
+        Scan every monitored instance for the hosts using the template
+    """
+    for metadata in get_instance_data([MONITORING_ENABLED_FILTER,
+                                       LIVE_INSTANCE_FILTER]):
+        if metadata[TEMPLATE_TAGS[kind]] == template_name:
+            yield metadata
+
+
+def get_host_templates(metadata):
+    """
+        Return templates used by the host, keyed by object kind
+    """
+    return dict((kind, metadata[TEMPLATE_TAGS[kind]])
+                for kind in HOST_OBJECT_KINDS)
+
+
+def load_instance_state(bucket):
+    """
+        Load monitored instances state snapshot, at most once per
+        invocation. Missing snapshot is started empty
+    """
+    with INSTANCE_STATE_LOCK:
+        if not INSTANCE_STATE['checked']:
+            data, etag = read_state_object(bucket,
+                                           INSTANCE_STATE_KEY,
+                                           INSTANCE_STATE['etag'])
+            if etag is None:
+                instances = {}
+            elif data is None:
+                # Snapshot was not modified since previous invocation
+                instances = INSTANCE_STATE['instances']
+            else:
+                instances = data['instances']
+            # Re-apply changes not saved yet
+            for instance_id, entry in INSTANCE_STATE['pending'].items():
+                if entry is None:
+                    instances.pop(instance_id, None)
+                else:
+                    instances[instance_id] = entry
+            for entry in instances.values():
+                # Stages uploaded by other Lambda containers
+                if entry.get('stage') is not None:
+                    STAGE_HASHES.setdefault(entry['metadata']['hostname'],
+                                            (entry['stage'], entry['digest']))
+            INSTANCE_STATE['instances'] = instances
+            INSTANCE_STATE['reverse'] = None
+            INSTANCE_STATE['etag'] = etag
+            INSTANCE_STATE['checked'] = True
+        return INSTANCE_STATE['instances']
+
+
+def get_indexed_hosts(bucket, kind, template_name):
+    """
+        Return hostnames which recorded metadata uses the template, or None
+        when instances state snapshot does not exist yet
+    """
+    with INSTANCE_STATE_LOCK:
+        instances = load_instance_state(bucket)
+        if INSTANCE_STATE['etag'] is None and not instances:
+            return None
+        if INSTANCE_STATE['reverse'] is None:
+            reverse = dict((object_kind, {}) for object_kind in HOST_OBJECT_KINDS)
+            for entry in instances.values():
+                hostname = entry['metadata']['hostname']
+                templates = get_host_templates(entry['metadata'])
+                for object_kind, name in templates.items():
+                    reverse[object_kind].setdefault(name, set()).add(hostname)
+            INSTANCE_STATE['reverse'] = reverse
+        return set(INSTANCE_STATE['reverse'][kind].get(template_name, ()))
+
+
+def get_instance_state(bucket, instance_id):
+    """
+        Return last known state of the instance, None when not monitored
+    """
+    with INSTANCE_STATE_LOCK:
+        return load_instance_state(bucket).get(instance_id)
+
+
+def record_instance_state(instance_id, metadata, stage=None, digest=None):
+    """
+        Record host metadata of the instance and its uploaded configuration
+        stage and digest (None metadata removes the instance)
+    """
+    if instance_id is None:
+        return
+    entry = None
+    if metadata is not None:
+        entry = {'metadata': metadata,
+                 'package': FLEET_PACKAGE or metadata['hostname'],
+                 'stage': stage,
+                 'digest': digest}
+    with INSTANCE_STATE_LOCK:
+        instances = INSTANCE_STATE['instances']
+        if instances is not None and instances.get(instance_id) == entry:
+            return
+        INSTANCE_STATE['pending'][instance_id] = entry
+        if instances is None:
+            return
+        INSTANCE_STATE['reverse'] = None
+        if entry is None:
+            instances.pop(instance_id, None)
+        else:
+            instances[instance_id] = entry
+
+
+def save_instance_state(bucket):
+    """
+        Write recorded instances changes to the state snapshot. Changes
+        are re-applied on top of the latest snapshot when it was updated
+        concurrently by another invocation
+    """
+    with INSTANCE_STATE_LOCK:
+        if not INSTANCE_STATE['pending']:
+            return
+        for _ in range(INSTANCE_STATE_RETRIES):
+            load_instance_state(bucket)
+            etag = write_state_object(bucket,
+                                      INSTANCE_STATE_KEY,
+                                      {'instances': INSTANCE_STATE['instances']},
+                                      INSTANCE_STATE['etag'])
+            if etag is not None:
+                INSTANCE_STATE['etag'] = etag
+                INSTANCE_STATE['pending'].clear()
+                LOGGER.info("Instance state saved with %d instances",
+                            len(INSTANCE_STATE['instances']))
+                return
+            # Snapshot was changed concurrently, reload and re-apply changes
+            INSTANCE_STATE['checked'] = False
+            INSTANCE_STATE['etag'] = None
+        LOGGER.error("Unable to save instance state after %d attempts",
+                     INSTANCE_STATE_RETRIES)
+
+
+def reset_invocation_state():
+    """
+        Forget listed Icinga2 configuration packages and instances state
+        snapshot version, reset invocation metrics and
+        decide whether invocation logs payloads in full
+    """
+    global PACKAGE_INDEX, LOG_SAMPLED
+    PACKAGE_INDEX = None
+    LOG_SAMPLED = random.random() < LOG_SAMPLE_RATE
+    with INSTANCE_STATE_LOCK:
+        INSTANCE_STATE['checked'] = False
+    with METRICS_LOCK:
+        METRICS['counters'].clear()
+        METRICS['values'].clear()
+
+
+def count_metric(name, value=1, unit='Count'):
+    """
+        Add value to invocation counter
+    """
+    with METRICS_LOCK:
+        counter = METRICS['counters'].setdefault(name, {'unit': unit,
+                                                        'value': 0})
+        counter['value'] += value
+
+
+def get_metric_count(name):
+    """
+        Return current value of invocation counter
+    """
+    with METRICS_LOCK:
+        return METRICS['counters'].get(name, {'value': 0})['value']
+
+
+def record_metric(name, value, unit='Milliseconds'):
+    """
+        Record single value (e.g. per-host latency) of invocation metric
+    """
+    with METRICS_LOCK:
+        METRICS['values'].setdefault(name, {'unit': unit,
+                                            'values': []})['values'].append(value)
+
+
+@contextmanager
+def timed(name):
+    """
+        Record duration of the block in milliseconds
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_metric(name, (time.time() - start) * 1000)
+
+
+def flush_metrics(function):
+    """
+        Print invocation metrics as CloudWatch Embedded Metric Format
+        documents and return them. Metrics with more than
+        METRICS_MAX_VALUES values are split across documents
+    """
+    with METRICS_LOCK:
+        counters = dict(METRICS['counters'])
+        values = dict(METRICS['values'])
+        METRICS['counters'].clear()
+        METRICS['values'].clear()
+    if not METRICS_NAMESPACE:
+        return []
+    documents = []
+    position = 0
+    while position == 0 or any(len(metric['values']) > position
+                               for metric in values.values()):
+        document = {'_aws': {'Timestamp': int(time.time() * 1000),
+                             'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE,
+                                                    'Dimensions': [['Function']],
+                                                    'Metrics': []}]},
+                    'Function': function}
+        definitions = document['_aws']['CloudWatchMetrics'][0]['Metrics']
+        if position == 0:
+            for name, counter in sorted(counters.items()):
+                definitions.append({'Name': name, 'Unit': counter['unit']})
+                document[name] = counter['value']
+        for name, metric in sorted(values.items()):
+            chunk = metric['values'][position:position + METRICS_MAX_VALUES]
+            if chunk:
+                definitions.append({'Name': name, 'Unit': metric['unit']})
+                document[name] = chunk
+        if definitions:
+            documents.append(document)
+        position += METRICS_MAX_VALUES
+    for document in documents:
+        sys.stdout.write(json.dumps(document, sort_keys=True) + '\n')
+    sys.stdout.flush()
+    return documents
+
+
+def stage_is_current(hostname,
+                     digest,
+                     api_endpoint,
+                     api_port,
+                     api_user,
+                     api_pass):
+    """
+        Check if active Icinga2 stage of the host package already contains
+        configuration with given SHA-256 digest. Active configuration file
+        is fetched only when its digest is not known yet
+    """
+    active_stage = get_package_index(api_endpoint,
+                                     api_port,
+                                     api_user,
+                                     api_pass).get(hostname)
+    if active_stage is None:
+        return False
+    known = STAGE_HASHES.get(hostname)
+    if known is None or known[0] != active_stage:
+        file_url = "https://{0}:{1}/v1/config/files/{2}/{3}/conf.d/{2}.conf".format(api_endpoint,
+                                                                                   api_port,
+                                                                                   hostname,
+                                                                                   active_stage)
+        active_conf = get_api_file(file_url, api_user, api_pass)
+        if active_conf is None:
+            return False
+        known = (active_stage, hashlib.sha256(active_conf).hexdigest())
+        STAGE_HASHES[hostname] = known
+    return known[1] == digest
+
+
+def load_package_files(package,
+                       known,
+                       api_endpoint,
+                       api_port,
+                       api_user,
+                       api_pass):
+    """
+        Return configuration files of the shared package active stage,
+        creating the package when it does not exist yet. Files are
+        downloaded only when active stage differs from the known one.
+        While stages uploaded by this container on top of the active stage
+        are validated by Icinga2 master, files of the last uploaded stage
+        are returned, so next stage does not drop their changes
+        Parameters:
+            - package: Icinga2 package name
+            - known: {'stage', 'files', 'lineage'} dict of the package kept
+                     by this Lambda container, updated with downloaded
+                     files. Lineage lists (stage, upload time) of stages
+                     uploaded since the stage files were based on
+    """
+    packages = get_package_index(api_endpoint, api_port, api_user, api_pass)
+    if package not in packages:
+        LOGGER.info('Creating pkg %s', package)
+        pkg_uri = "https://{0}:{1}/v1/config/packages/{2}".format(api_endpoint,
+                                                                  api_port,
+                                                                  package)
+        post_api_request(pkg_uri, api_user, api_pass)
+        packages[package] = None
+    active_stage = packages[package]
+    if known['stage'] == active_stage:
+        known['lineage'] = [(active_stage, None)]
+        return known['files']
+    lineage = known.get('lineage') or []
+    stages = [stage for stage, _ in lineage]
+    if active_stage in stages:
+        # Stages uploaded after the active one are not activated yet
+        lineage = lineage[stages.index(active_stage):]
+        known['lineage'] = lineage
+        if known['stage'] in PACKAGE_STAGES.get(package, ()) and \
+                time.time() - lineage[1][1] < STAGE_VALIDATION_TIMEOUT:
+            return known['files']
+        LOGGER.warning("Stage %s of %s was not activated, using active stage %s",
+                       known['stage'], package, active_stage)
+    known['lineage'] = [(active_stage, None)]
+    if active_stage is None:
+        known['stage'] = None
+        known['files'] = {}
+        return {}
+    stage_url = "https://{0}:{1}/v1/config/stages/{2}/{3}".format(api_endpoint,
+                                                                  api_port,
+                                                                  package,
+                                                                  active_stage)
+    files = {}
+    for item in get_api_request(stage_url, api_user, api_pass) or []:
+        if item.get('type') != 'file' or not item['name'].startswith('conf.d/'):
+            continue
+        file_url = "{0}/{1}".format(stage_url.replace('/config/stages/',
+                                                      '/config/files/'),
+                                    item['name'])
+        conf = get_api_file(file_url, api_user, api_pass)
+        if conf is not None:
+            files[item['name']] = conf.decode('utf-8')
+    known['stage'] = active_stage
+    known['files'] = files
+    return files
+
+
+def upload_package_files(package,
+                         known,
+                         files,
+                         api_endpoint,
+                         api_port,
+                         api_user,
+                         api_pass):
+    """
+        Upload every file of the shared package as its new stage.
+        Returns uploaded stage name, None when upload failed
+    """
+    lineage = known.get('lineage') or [(known['stage'], None)]
+    stg_uri = "https://{0}:{1}/v1/config/stages/{2}".format(api_endpoint,
+                                                            api_port,
+                                                            package)
+    payload = json.dumps({'files': files})
+    count_metric('icinga.bytes_uploaded', len(payload), 'Bytes')
+    with timed('icinga.stage_upload'):
+        response_data = post_api_request(stg_uri,
+                                         api_user,
+                                         api_pass,
+                                         payload)
+    try:
+        stage = response_data['results'][0]['stage']
+    except (TypeError, KeyError, IndexError):
+        return None
+    # Stage becomes active once Icinga2 master validates it, until then
+    # package index keeps the active stage
+    known['stage'] = stage
+    known['files'] = files
+    known['lineage'] = lineage + [(stage, time.time())]
+    with PACKAGE_INDEX_LOCK:
+        PACKAGE_STAGES.setdefault(package, set()).add(stage)
+    return stage
+
+
+def load_fleet_files(api_endpoint,
+                     api_port,
+                     api_user,
+                     api_pass):
+    """
+        Return configuration files of the fleet package active stage
+    """
+    return load_package_files(FLEET_PACKAGE,
+                              FLEET_FILES,
+                              api_endpoint,
+                              api_port,
+                              api_user,
+                              api_pass)
+
+
+def queue_fleet_file(hostname,
+                     content,
+                     api_endpoint,
+                     api_port,
+                     api_user,
+                     api_pass):
+    """
+        Queue host configuration for the next fleet package stage upload.
+        None content removes host configuration from the fleet package.
+        Queue is flushed once it holds FLEET_BATCH_SIZE hosts or is older
+        than FLEET_FLUSH_INTERVAL seconds
+    """
+    global FLEET_QUEUE_SINCE
+    conf_path = 'conf.d/{0}.conf'.format(hostname)
+    with FLEET_LOCK:
+        active = load_fleet_files(api_endpoint, api_port, api_user, api_pass)
+        if conf_path not in FLEET_QUEUE and active.get(conf_path) == content:
+            LOGGER.info("Configuration unchanged for: %s", hostname)
+            count_metric('stages.unchanged')
+            return
+        FLEET_QUEUE[conf_path] = content
+        count_metric('stages.uploaded')
+        if FLEET_QUEUE_SINCE is None:
+            FLEET_QUEUE_SINCE = time.time()
+        if len(FLEET_QUEUE) >= FLEET_BATCH_SIZE or \
+                time.time() - FLEET_QUEUE_SINCE >= FLEET_FLUSH_INTERVAL:
+            flush_fleet_stage(api_endpoint, api_port, api_user, api_pass)
+
+
+def flush_fleet_stage(api_endpoint,
+                      api_port,
+                      api_user,
+                      api_pass):
+    """
+        Upload queued hosts configuration as single fleet package stage.
+        Stage contains every file of the active (or last uploaded) stage
+        with queued changes applied, so hosts outside of the batch are
+        preserved. Queue is kept when upload fails.
+        Stages uploaded concurrently by other Lambda containers are not
+        merged, the last one wins and reconciliation restores hosts
+        missing from it
+    """
+    global FLEET_QUEUE_SINCE
+    with FLEET_LOCK:
+        if not FLEET_QUEUE:
+            return
+        files = dict(load_fleet_files(api_endpoint, api_port, api_user, api_pass))
+        for conf_path, content in FLEET_QUEUE.items():
+            if content is None:
+                files.pop(conf_path, None)
+            else:
+                files[conf_path] = content
+        if upload_package_files(FLEET_PACKAGE,
+                                FLEET_FILES,
+                                files,
+                                api_endpoint,
+                                api_port,
+                                api_user,
+                                api_pass) is None:
+            raise RuntimeError("Unable to upload fleet stage with {0} changed "
+                               "hosts".format(len(FLEET_QUEUE)))
+        LOGGER.info("Fleet stage uploaded with %d changed hosts", len(FLEET_QUEUE))
+        FLEET_QUEUE.clear()
+        FLEET_QUEUE_SINCE = None
+
+
+def wait_teardown_slot():
+    """
+        Block until next package deletion is allowed by TEARDOWN_RATE
+    """
+    global TEARDOWN_NEXT
+    if TEARDOWN_RATE <= 0:
+        return
+    with TEARDOWN_LOCK:
+        now = time.time()
+        slot = max(now, TEARDOWN_NEXT)
+        TEARDOWN_NEXT = slot + 1.0 / TEARDOWN_RATE
+    if slot > now:
+        time.sleep(slot - now)
+
+
+def render_service_rules(template_name, template):
+    """
+        Render Icinga2 service templates and apply rules of the service
+        template
+    """
+    return render_many('service',
+                       [{'data': {}, 'template': service, 'apply': template_name}
+                        for service in template or []])
+
+
+def sync_service_rules(template_name,
+                       template,
+                       fingerprint,
+                       api_endpoint,
+                       api_port,
+                       api_user,
+                       api_pass):
+    """
+        Make sure services package holds up to date apply rules of the
+        service template, uploading new services package stage when they
+        differ. Rules are rendered only when template fingerprint or the
+        package stage has changed. New stage is built on the last uploaded
+        one while Icinga2 master validates it, so rules of templates synced
+        meanwhile are kept
+    """
+    conf_path = 'conf.d/{0}.conf'.format(template_name)
+    with SERVICE_RULES_LOCK:
+        files = load_package_files(SERVICE_APPLY_PACKAGE,
+                                   SERVICE_RULES,
+                                   api_endpoint,
+                                   api_port,
+                                   api_user,
+                                   api_pass)
+        synced = (SERVICE_RULES['stage'], fingerprint)
+        if fingerprint is not None and \
+                SERVICE_RULES['synced'].get(conf_path) == synced:
+            return
+        content = render_service_rules(template_name, template)
+        if files.get(conf_path, '') != content:
+            files = dict(files)
+            if content:
+                files[conf_path] = content
+            else:
+                files.pop(conf_path, None)
+            if upload_package_files(SERVICE_APPLY_PACKAGE,
+                                    SERVICE_RULES,
+                                    files,
+                                    api_endpoint,
+                                    api_port,
+                                    api_user,
+                                    api_pass) is None:
+                raise RuntimeError("Unable to upload service rules of "
+                                   "{0}".format(template_name))
+            LOGGER.info("Service rules uploaded for template: %s", template_name)
+        SERVICE_RULES['synced'][conf_path] = (SERVICE_RULES['stage'], fingerprint)
 
 
 def delete_monitoring(metadata,
@@ -701,15 +2105,96 @@ def delete_monitoring(metadata,
     """
         Delete monitoring configuration from Icinga2 master
     """
+    if FLEET_PACKAGE:
+        queue_fleet_file(metadata['hostname'],
+                         None,
+                         api_endpoint,
+                         api_port,
+                         api_user,
+                         api_pass)
+        record_instance_state(metadata.get('instance_id'), None)
+        LOGGER.info("Removed Icinga2 configuration for %s", metadata['hostname'])
+        return
     pkg_url = "https://{0}:{1}/v1/config/packages/{2}".format(api_endpoint,
                                                               api_port,
                                                               metadata['hostname'])
-    delete_api_request(pkg_url,
-                       api_user,
-                       api_pass)
+    packages = get_package_index(api_endpoint, api_port, api_user, api_pass)
+    if packages and metadata['hostname'] not in packages:
+        # Already removed, Icinga2 fails deletion of missing package
+        LOGGER.info("Package %s does not exist", metadata['hostname'])
+    else:
+        wait_teardown_slot()
+        if delete_api_request(pkg_url,
+                              api_user,
+                              api_pass) is None:
+            # Package is kept in instances state, so reconciliation retries it
+            raise RuntimeError("Unable to delete package {0}".format(metadata['hostname']))
+    record_instance_state(metadata.get('instance_id'), None)
+    if PACKAGE_INDEX is not None:
+        PACKAGE_INDEX.pop(metadata['hostname'], None)
+    STAGE_HASHES.pop(metadata['hostname'], None)
     LOGGER.info("Removed Icinga2 configuration for %s", metadata['hostname'])
 
 
+def assemble_stage(conf_path, fragments):
+    """
+        Serialize stage payload of the configuration file made of
+        fragments in one pass, feeding every fragment into rolling SHA-256
+        hash of the file. Returns (payload, digest) tuple
+    """
+    digest = hashlib.sha256()
+    parts = ['{"files": {', json.dumps(conf_path), ': "']
+    for fragment in fragments:
+        digest.update(fragment.encode('utf-8'))
+        # JSON string escaping is per character, escaped fragments can be
+        # concatenated as is
+        parts.append(json.dumps(fragment)[1:-1])
+    parts.append('"}}')
+    return ''.join(parts), digest.hexdigest()
+
+
+def render_host_object(kind, metadata, template, fingerprint=None):
+    """
+        Render Icinga2 object(s) of given kind for the host.
+        With template fingerprint (or missing template) objects are rendered
+        once per template with host fields as placeholders, the host gets
+        the shared block with its fields substituted
+    """
+    if fingerprint is None and template is not None:
+        return render_object_block(kind, metadata, template)
+    render_key = (kind, fingerprint, tuple(sorted(metadata)))
+    with RENDER_CACHE_LOCK:
+        block = RENDER_CACHE.get(render_key)
+        if block is not None:
+            RENDER_CACHE.move_to_end(render_key)
+    count_metric('render.cache_hit' if block is not None else 'render.cache_miss')
+    if block is None:
+        placeholders = dict((field, HOST_FIELD_PLACEHOLDER.format(field))
+                            for field in metadata)
+        block = render_object_block(kind, placeholders, template)
+        with RENDER_CACHE_LOCK:
+            RENDER_CACHE[render_key] = block
+            while len(RENDER_CACHE) > RENDER_CACHE_SIZE:
+                RENDER_CACHE.popitem(last=False)
+    return HOST_FIELD_PATTERN.sub(lambda match: str(metadata[match.group(1)]),
+                                  block)
+
+
+def render_object_block(kind, metadata, template):
+    """
+        Render Icinga2 object(s) of given kind from the template
+    """
+    if kind == 'endpoint':
+        return generate_endpoint_configuration(metadata, template)
+    if kind == 'zone':
+        return generate_zone_configuration(metadata, template)
+    if kind == 'host':
+        return generate_host_configuration(metadata, template)
+    return render_many('service',
+                       [{'data': metadata, 'template': service}
+                        for service in template or []])
+
+
 def setup_monitoring(metadata,
                      template_bucket,
                      api_endpoint,
@@ -718,103 +2203,601 @@ def setup_monitoring(metadata,
                      api_pass):
     """
         Setup monitoring for host in Icinga2 master by creating Icinga2
-        package/stage files in Icinga2 master
+        package/stage files in Icinga2 master. Every object is rendered
+        from current templates, objects rendered from unchanged templates
+        are served by the render cache
         Parameters:
-            - instance_id: ec2 instance ID
-    """
-    templates = {}
-    templates['endpoint'] = "endpoint/{0}".format(metadata['l2i_endpoint_template'])
-    templates['zone'] = "zone/{0}".format(metadata['l2i_zone_template'])
-    templates['host'] = "host/{0}".format(metadata['l2i_host_template'])
-    templates['service'] = "service/{0}".format(metadata['l2i_service_template'])
-
-    # Retrieve endpoint configuration template
-    endpoint_conf_tpl = get_conf_template(template_bucket,
-                                          templates['endpoint'])
-    # Retrieve zone configuration template
-    zone_conf_tpl = get_conf_template(template_bucket,
-                                      templates['zone'])
-    # Retrieve host configuration template from template store (S3 bucket)
-    host_conf_tpl = get_conf_template(template_bucket,
-                                      templates['host'])
-    # Retrieve service configuration template from template store (S3 bucket)
-    service_conf_tpl = get_conf_template(template_bucket,
-                                         templates['service'])
-    LOGGER.info(yaml.load(host_conf_tpl))
-    LOGGER.info(yaml.load(service_conf_tpl))
-    # Step 1: Check if configuration package exist
+            - metadata: host metadata
+    """
+    hostname = metadata['hostname']
+    fragments = {}
+    with timed('render.host'):
+        for kind in HOST_OBJECT_KINDS:
+            # Retrieve object configuration template from template store (S3 bucket)
+            template_key = "{0}/{1}".format(kind, metadata[TEMPLATE_TAGS[kind]])
+            template, fingerprint = get_template(template_bucket, template_key)
+            if kind == 'service' and SERVICE_APPLY_PACKAGE:
+                # Services are applied by rules shared by every host using
+                # the template
+                sync_service_rules(metadata[TEMPLATE_TAGS[kind]],
+                                   template,
+                                   fingerprint,
+                                   api_endpoint,
+                                   api_port,
+                                   api_user,
+                                   api_pass)
+                fragments[kind] = ''
+                continue
+            fragments[kind] = render_host_object(kind,
+                                                 metadata,
+                                                 template,
+                                                 fingerprint)
+    ordered = [fragments[kind] for kind in HOST_OBJECT_KINDS]
+    LOGGER.debug("Configuration of %s: %s",
+                 hostname,
+                 LogPayload(lambda: ''.join(ordered)))
+    if FLEET_PACKAGE:
+        # Host configuration is uploaded with the next fleet stage
+        queue_fleet_file(metadata['hostname'],
+                         ''.join(ordered),
+                         api_endpoint,
+                         api_port,
+                         api_user,
+                         api_pass)
+        record_instance_state(metadata['instance_id'], metadata)
+        return
+    # Check if configuration package exist
     pkg_base_url = "https://{0}:{1}/v1/config/packages".format(api_endpoint,
                                                                api_port)
-    packages = get_api_request(pkg_base_url, api_user, api_pass)
+    packages = get_package_index(api_endpoint, api_port, api_user, api_pass)
     pkg_uri = pkg_base_url + "/{0}".format(metadata['hostname'])
     stg_uri = "https://{0}:{1}/v1/config/stages/{2}".format(api_endpoint,
                                                             api_port,
                                                             metadata['hostname'])
-    conf_exist = False
-    # check if package for the host exist
-    for package in packages:
-        if package['name'] == metadata['hostname']:
-            conf_exist = True
-            break
     # if configuration package does not exist, create new one
-    if not conf_exist:
+    if metadata['hostname'] not in packages:
         LOGGER.info('Creating pkg %s', metadata['hostname'])
         post_api_request(pkg_uri, api_user, api_pass)
-
-    # Generate endpoint configuration
-    content = generate_endpoint_configuration(metadata, yaml.load(endpoint_conf_tpl))
-    # Generate zone configuration
-    content += generate_zone_configuration(metadata, yaml.load(zone_conf_tpl))
-    # Generate host configuration content
-    content += generate_host_configuration(metadata, yaml.load(host_conf_tpl))
-    # Generate service configuration content
-    services = yaml.load(service_conf_tpl)
-    for service in services:
-        content += generate_service_configuration(metadata, service)
-    LOGGER.info(content)
+        packages[metadata['hostname']] = None
+    conf_path = 'conf.d/{0}.conf'.format(metadata['hostname'])
+    payload, digest = assemble_stage(conf_path, ordered)
+    if stage_is_current(metadata['hostname'],
+                        digest,
+                        api_endpoint,
+                        api_port,
+                        api_user,
+                        api_pass):
+        LOGGER.info("Configuration unchanged for: %s", metadata['hostname'])
+        count_metric('stages.unchanged')
+        record_instance_state(metadata['instance_id'],
+                              metadata,
+                              *STAGE_HASHES[metadata['hostname']])
+        return
     # Create host configuration stage
-    if content is not None:
-        data = {}
-        conf_path = 'conf.d/{0}.conf'.format(metadata['hostname'])
-        data['files'] = {conf_path: content}
-        post_api_request(stg_uri,
+    count_metric('icinga.bytes_uploaded', len(payload), 'Bytes')
+    with timed('icinga.stage_upload'):
+        response_data = post_api_request(stg_uri,
+                                         api_user,
+                                         api_pass,
+                                         payload)
+    try:
+        stage = response_data['results'][0]['stage']
+    except (TypeError, KeyError, IndexError):
+        # Deployed configuration and recorded state are left as they are
+        raise RuntimeError("Unable to upload stage of {0}".format(metadata['hostname']))
+    # Stage becomes active once Icinga2 master validates it
+    STAGE_HASHES[metadata['hostname']] = (stage, digest)
+    record_instance_state(metadata['instance_id'], metadata, stage, digest)
+    count_metric('stages.uploaded')
+    LOGGER.info("Monitoring enabled for: %s", metadata['hostname'])
+
+
+def get_instances_by_value(filter_name, values, ec2_filter=None, targets=None):
+    """
+        Get EC2 instances matching any of the filter values, in as few
+        describe_instances calls as filter values limit allows
+    """
+    for i in range(0, len(values), EC2_FILTER_CHUNK):
+        chunk_filter = list(ec2_filter or [])
+        chunk_filter.append({
+            "Name": filter_name,
+            "Values": values[i:i + EC2_FILTER_CHUNK]})
+        for metadata in get_instance_data(chunk_filter, targets):
+            yield metadata
+
+
+def get_instances_by_id(instance_ids, ec2_filter=None, targets=None):
+    """
+        Get EC2 instances by their IDs. Instances are described only in
+        their (role ARN, region) target mapped by instance ID in targets,
+        instances without known target are looked up in every region
+    """
+    grouped = {}
+    for instance_id in instance_ids:
+        target = (targets or {}).get(instance_id)
+        grouped.setdefault(target, []).append(instance_id)
+    for target, target_ids in grouped.items():
+        for metadata in get_instances_by_value('instance-id',
+                                               target_ids,
+                                               ec2_filter,
+                                               None if target is None else [target]):
+            yield metadata
+
+
+def get_instances_by_name(hostnames, ec2_filter=None):
+    """
+        Get EC2 instances by their Name tag
+    """
+    return get_instances_by_value('tag:Name', hostnames, ec2_filter)
+
+
+def get_teardown_hosts(instance_ids, state_bucket, targets=None):
+    """
+        Resolve hosts of removed instances. Instances found in instances
+        state are used as recorded (terminated instances may have lost
+        their tags), remaining instances are described in batches, in
+        their target region when known (see get_instances_by_id)
+    """
+    unknown = []
+    for instance_id in instance_ids:
+        entry = get_instance_state(state_bucket, instance_id)
+        if entry is None:
+            unknown.append(instance_id)
+        else:
+            yield entry['metadata']
+    if unknown:
+        for metadata in get_instances_by_id(unknown, targets=targets):
+            yield metadata
+
+
+def get_event_instance_ids(event):
+    """
+        Return IDs of EC2 instances listed in CloudTrail tagging event
+    """
+    items = event['detail']['requestParameters']['resourcesSet']['items']
+    return [item['resourceId'] for item in items
+            if item['resourceId'].startswith('i-')]
+
+
+def get_changed_kinds(tag_keys):
+    """
+        Return object kinds affected by changed l2i_*_template tags
+    """
+    return [kind for kind in HOST_OBJECT_KINDS
+            if TEMPLATE_TAGS[kind] in tag_keys]
+
+
+def deadline_reached(context):
+    """
+        Check if Lambda invocation is about to time out
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < PROVISION_DEADLINE_MARGIN
+
+
+def run_provisioning(action,
+                     hosts,
+                     context,
+                     *args):
+    """
+        Run provisioning action (setup_monitoring/delete_monitoring) for
+        every host across bounded worker pool
+        Parameters:
+            - action: function called as action(metadata, *args)
+            - hosts: iterable of host metadata
+            - context: Lambda context, used to stop scheduling new hosts
+                       once invocation is about to time out
+        Returns dict with succeeded, failed and skipped hostnames, and
+        instance IDs of every taken host mapped by hostname. Hosts left in
+        the iterable once deadline is reached are not described,
+        'incomplete' is then set and only the host taken last is skipped
+    """
+    results = {'succeeded': [], 'failed': {}, 'skipped': [],
+               'instances': {}, 'incomplete': False}
+
+    def run(metadata):
+        with timed('{0}.latency'.format(action.__name__)):
+            action(metadata, *args)
+
+    def collect(futures):
+        for future in futures:
+            hostname = running.pop(future)
+            err = future.exception()
+            if err is None:
+                results['succeeded'].append(hostname)
+            else:
+                LOGGER.error("Provisioning failed for %s: %r", hostname, err)
+                results['failed'][hostname] = repr(err)
+
+    running = {}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=PROVISION_CONCURRENCY) as executor:
+        for metadata in hosts:
+            results['instances'][metadata['hostname']] = metadata.get('instance_id')
+            if deadline_reached(context):
+                LOGGER.warning("Invocation deadline reached. "
+                               "Remaining hosts are not scheduled")
+                results['skipped'].append(metadata['hostname'])
+                results['incomplete'] = True
+                break
+            if len(running) >= PROVISION_CONCURRENCY:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            running[executor.submit(run, metadata)] = metadata['hostname']
+        collect(wait(running)[0])
+    record_metric('{0}.duration'.format(action.__name__),
+                  (time.time() - start) * 1000)
+    for name in ('succeeded', 'failed', 'skipped'):
+        count_metric('{0}.{1}'.format(action.__name__, name), len(results[name]))
+    LOGGER.info("%s: %d succeeded, %d failed, %d skipped%s",
+                action.__name__,
+                len(results['succeeded']),
+                len(results['failed']),
+                len(results['skipped']),
+                ' (remaining hosts not scheduled)'
+                if results['incomplete'] else '')
+    return results
+
+
+def schedule_downtime(hostnames,
+                      duration,
+                      api_endpoint,
+                      api_port,
+                      api_user,
+                      api_pass,
+                      comment):
+    """
+        Send request to downtime Icinga2 host checks of many hosts at once.
+        Hosts are matched by single filter, one request is sent per
+        DOWNTIME_CHUNK_SIZE hosts
+        Parameters:
+            - hostnames: hosts to downtime
+            - duration: downtime duration in minutes
+    """
+    url = "https://{0}:{1}/v1/actions/schedule-downtime".format(api_endpoint,
+                                                                api_port)
+    hostnames = sorted(hostnames)
+    now = datetime.utcnow()
+    start_time = calendar.timegm(now.utctimetuple())
+    end_timestamp = now + timedelta(minutes=duration)
+    end_time = calendar.timegm(end_timestamp.utctimetuple())
+    for i in range(0, len(hostnames), DOWNTIME_CHUNK_SIZE):
+        downtime_data = {}
+        downtime_data['type'] = 'Host'
+        downtime_data['filter'] = 'host.name in hosts'
+        downtime_data['filter_vars'] = {'hosts': hostnames[i:i + DOWNTIME_CHUNK_SIZE]}
+        downtime_data['start_time'] = start_time
+        downtime_data['end_time'] = end_time
+        downtime_data['author'] = 'automagic-lambda2icinga'
+        downtime_data['comment'] = comment
+        post_api_request(url,
                          api_user,
                          api_pass,
-                         json.dumps(data))
-        LOGGER.info("Monitoring enabled for: %s", metadata['hostname'])
+                         json.dumps(downtime_data))
+    LOGGER.info("Check downtimed for %d hosts", len(hostnames))
 
 
-def downtime_check(url,
-                   duration,
-                   api_user,
-                   api_pass,
-                   comment):
+def new_plan():
     """
-        Send request to downtime Icinga2 check
+        Create empty provisioning plan.
+        Plan maps instance IDs to their last requested action:
+            - setup: configure host objects, 'kinds' lists object kinds
+                     which templates changed (None for all kinds) and
+                     is optionally followed by host check 'downtime'
+            - delete: remove host configuration
+            - terminate: remove host configuration, instance will not come
+                         back so later events for it are ignored
+        with (role ARN, region) 'target' instance is described in (None
+        when unknown), lists templates which hosts have to be re-rendered
+        and IDs of SQS messages behind each planned instance ID or
+        (object kind, template name)
     """
-    downtime_data = {}
-    now = datetime.utcnow()
-    downtime_data['start_time'] = calendar.timegm(now.utctimetuple())
-    end_timestamp = datetime.utcnow() + timedelta(minutes=duration)
-    downtime_data['end_time'] = calendar.timegm(end_timestamp.timetuple())
-    downtime_data['author'] = 'automagic-lambda2icinga'
-    downtime_data['comment'] = comment
-    post_api_request(url,
-                     api_user,
-                     api_pass,
-                     json.dumps(downtime_data))
-    LOGGER.info("Check downtimed for: %s", url)
+    return {'instances': {}, 'templates': set(), 'downtime': set(),
+            'messages': {}}
 
 
-def handler(event, context):
+def plan_instance(plan,
+                  instance_id,
+                  action,
+                  kinds=None,
+                  downtime=False,
+                  target=None,
+                  message_id=None):
     """
-        AWS Lambda main method
+        Record action requested for the instance, replacing earlier one
+    """
+    if message_id is not None:
+        plan['messages'].setdefault(instance_id, set()).add(message_id)
+    current = plan['instances'].get(instance_id)
+    if current is not None:
+        if current['action'] == 'terminate':
+            return
+        target = target or current['target']
+        if action == 'setup' and current['action'] == 'setup':
+            # Merge re-rendered object kinds of both events
+            if current['kinds'] is None or kinds is None:
+                kinds = None
+            else:
+                kinds = current['kinds'] | set(kinds)
+            downtime = downtime or current['downtime']
+    plan['instances'][instance_id] = {
+        'action': action,
+        'kinds': None if kinds is None else set(kinds),
+        'downtime': downtime,
+        'target': target}
+
+
+def add_event_to_plan(plan, event, message_id=None):
+    """
+        Translate EventBridge or S3 notification event into plan actions,
+        recording SQS message the event was delivered by
+    """
+    if event.get('source') == 'aws.ec2':
+        # Instances are described only in the account and region of event
+        target = get_event_target(event)
+        if event['detail-type'] == 'EC2 Instance State-change Notification':
+            instance_id = event['detail']['instance-id']
+            if event['detail']['state'] == 'running':
+                plan_instance(plan, instance_id, 'setup', target=target,
+                              message_id=message_id)
+            elif event['detail']['state'] == 'terminated':
+                plan_instance(plan, instance_id, 'terminate', target=target,
+                              message_id=message_id)
+        elif event['detail-type'] == 'AWS API Call via CloudTrail':
+            event_name = event['detail']['eventName']
+            instance_ids = get_event_instance_ids(event)
+            tag_keys = set(tag['key'] for tag in
+                           event['detail']['requestParameters']['tagSet']['items'])
+            kinds = get_changed_kinds(tag_keys)
+            for instance_id in instance_ids:
+                if event_name == 'CreateTags':
+                    if 'lambda2icinga' in tag_keys:
+                        # Monitoring enabled, configure all host objects
+                        plan_instance(plan, instance_id, 'setup',
+                                      downtime=True, target=target,
+                                      message_id=message_id)
+                    elif kinds:
+                        plan_instance(plan, instance_id, 'setup', kinds,
+                                      target=target, message_id=message_id)
+                elif event_name == 'DeleteTags':
+                    if 'lambda2icinga' in tag_keys:
+                        plan_instance(plan, instance_id, 'delete', target=target,
+                                      message_id=message_id)
+                    elif kinds:
+                        # Removed template tags fall back to default templates
+                        plan_instance(plan, instance_id, 'setup', kinds,
+                                      target=target, message_id=message_id)
+    else:
+        for record in event.get('Records', []):
+            if record.get('eventSource') != 'aws:s3':
+                continue
+            object_key = unquote_plus(record['s3']['object']['key'])
+            # Template was updated or removed, drop its cached copy
+            invalidate_conf_template(record['s3']['bucket']['name'],
+                                     object_key)
+            kind, _, template_name = object_key.partition('/')
+            if kind in HOST_OBJECT_KINDS:
+                plan['templates'].add((kind, template_name))
+                if message_id is not None:
+                    plan['messages'].setdefault((kind, template_name),
+                                                set()).add(message_id)
+
+
+def plan_batch(records):
+    """
+        Coalesce SQS batch of EventBridge/S3 events into single plan.
+        Events are applied in their occurrence order, so the last event
+        of each instance wins
+    """
+    events = []
+    for position, record in enumerate(records):
+        try:
+            event = json.loads(record['body'])
+        except (KeyError, ValueError):
+            LOGGER.warning("Skipping malformed SQS message: %s",
+                           record.get('messageId'))
+            continue
+        event_time = event.get('time') or \
+            event.get('Records', [{}])[0].get('eventTime', '')
+        events.append((event_time, position, event, record.get('messageId')))
+    plan = new_plan()
+    for _, _, event, message_id in sorted(events, key=lambda item: item[:2]):
+        add_event_to_plan(plan, event, message_id)
+    LOGGER.info("Coalesced %d events into %d instance actions and "
+                "%d template updates",
+                len(events),
+                len(plan['instances']),
+                len(plan['templates']))
+    return plan
+
+
+def get_plan_targets(plan):
+    """
+        Return (role ARN, region) targets of planned instances, mapped by
+        instance ID
+    """
+    return dict((instance_id, entry['target'])
+                for instance_id, entry in plan['instances'].items()
+                if entry.get('target') is not None)
+
+
+def resolve_template_hosts(plan, state_bucket):
+    """
+        Return hostnames using templates listed in the plan
+    """
+    hostnames = set()
+    for kind, template_name in sorted(plan['templates']):
+        hosts = get_indexed_hosts(state_bucket, kind, template_name)
+        if hosts is None:
+            LOGGER.info("Instances state is missing, scanning instances")
+            hosts = set(metadata['hostname'] for metadata in
+                        scan_template_hosts(kind, template_name))
+        hostnames.update(hosts)
+    return hostnames
+
+
+def iter_planned_hosts(plan, template_hosts, state_bucket):
+    """
+        Yield metadata of hosts to configure, each instance once.
+        Hosts re-rendered for changed templates are taken from instances
+        state, only hosts missing there are described
+    """
+    setup_ids = sorted(instance_id for instance_id, entry
+                       in plan['instances'].items()
+                       if entry['action'] == 'setup')
+    seen = set()
+    for metadata in get_instances_by_id(setup_ids,
+                                        [MONITORING_ENABLED_FILTER,
+                                         LIVE_INSTANCE_FILTER],
+                                        get_plan_targets(plan)):
+        seen.add(metadata['instance_id'])
+        if plan['instances'][metadata['instance_id']]['downtime']:
+            plan['downtime'].add(metadata['hostname'])
+        yield metadata
+    hostnames = set(template_hosts)
+    with INSTANCE_STATE_LOCK:
+        recorded = [entry['metadata'] for entry in
+                    load_instance_state(state_bucket).values()
+                    if entry['metadata']['hostname'] in hostnames]
+    for metadata in recorded:
+        if metadata['instance_id'] not in seen and \
+                metadata['instance_id'] not in plan['instances']:
+            seen.add(metadata['instance_id'])
+            hostnames.discard(metadata['hostname'])
+            yield metadata
+    for metadata in get_instances_by_name(sorted(hostnames),
+                                          [MONITORING_ENABLED_FILTER,
+                                           LIVE_INSTANCE_FILTER]):
+        if metadata['instance_id'] not in seen and \
+                metadata['instance_id'] not in plan['instances']:
+            seen.add(metadata['instance_id'])
+            yield metadata
+
+
+def execute_plan(plan,
+                 context,
+                 template_bucket,
+                 state_bucket,
+                 api_endpoint,
+                 api_port,
+                 api_user,
+                 api_pass):
+    """
+        Apply provisioning plan in one pass: remove configuration of
+        deleted hosts, then configure remaining hosts
+    """
+    results = {}
+    delete_ids = sorted(instance_id for instance_id, entry
+                        in plan['instances'].items()
+                        if entry['action'] in ('delete', 'terminate'))
+    if delete_ids:
+        results['delete'] = run_provisioning(delete_monitoring,
+                                             get_teardown_hosts(delete_ids,
+                                                                state_bucket,
+                                                                get_plan_targets(plan)),
+                                             context,
+                                             api_endpoint,
+                                             api_port,
+                                             api_user,
+                                             api_pass)
+    if SERVICE_APPLY_PACKAGE:
+        # Edited service templates only change their shared apply rules
+        for kind, template_name in sorted(plan['templates']):
+            if kind == 'service':
+                template_key = "service/{0}".format(template_name)
+                plan['templates'].discard((kind, template_name))
+                try:
+                    template, fingerprint = get_template(template_bucket, template_key)
+                    sync_service_rules(template_name,
+                                       template,
+                                       fingerprint,
+                                       api_endpoint,
+                                       api_port,
+                                       api_user,
+                                       api_pass)
+                except (ValueError, RuntimeError) as err:
+                    # Deployed apply rules are kept
+                    LOGGER.error("Unable to sync service rules of %s: %s",
+                                 template_name, err)
+                    results.setdefault('failed_templates', []).append(
+                        (kind, template_name))
+    template_hosts = resolve_template_hosts(plan, state_bucket)
+    if template_hosts or len(delete_ids) < len(plan['instances']):
+        results['setup'] = run_provisioning(setup_monitoring,
+                                            iter_planned_hosts(plan,
+                                                               template_hosts,
+                                                               state_bucket),
+                                            context,
+                                            template_bucket,
+                                            api_endpoint,
+                                            api_port,
+                                            api_user,
+                                            api_pass)
+        # Downtime just created hosts checks
+        downtime_hosts = plan['downtime'].intersection(results['setup']['succeeded'])
+        if downtime_hosts:
+            if FLEET_PACKAGE:
+                # Hosts have to be uploaded to be downtimed
+                flush_fleet_stage(api_endpoint, api_port, api_user, api_pass)
+            schedule_downtime(downtime_hosts,
+                              NEW_HOST_DOWNTIME,
+                              api_endpoint,
+                              api_port,
+                              api_user,
+                              api_pass,
+                              'New host {0} min auto-downtime'.format(NEW_HOST_DOWNTIME))
+    return results
+
+
+def get_batch_failures(plan, results):
+    """
+        Return SQS batch item failures for messages behind instances which
+        provisioning failed or was skipped, so only those are redelivered.
+        Hosts re-rendered for templates fail every template message
+    """
+    failed_ids = set()
+    failed_keys = set(results.get('failed_templates', []))
+    for action, planned in (('delete', ('delete', 'terminate')),
+                            ('setup', ('setup',))):
+        run = results.get(action)
+        if run is None:
+            continue
+        for hostname in set(run['failed']) | set(run['skipped']):
+            instance_id = run['instances'].get(hostname)
+            if instance_id in plan['instances']:
+                failed_ids.add(instance_id)
+            else:
+                failed_keys.update(plan['templates'])
+        if run['incomplete']:
+            # Hosts never taken are unknown, retry every remaining one
+            taken = set(run['instances'].values())
+            failed_ids.update(instance_id for instance_id, entry
+                              in plan['instances'].items()
+                              if entry['action'] in planned and
+                              instance_id not in taken)
+            if action == 'setup':
+                failed_keys.update(plan['templates'])
+    message_ids = set()
+    for key in failed_ids | failed_keys:
+        message_ids.update(plan['messages'].get(key, ()))
+    return [{'itemIdentifier': message_id} for message_id in sorted(message_ids)]
+
+
+def get_settings():
+    """
+        Read function settings from environment variables.
+        Returns (template_bucket, state_bucket, api_endpoint, api_port,
+        api_user, api_pass) tuple
     """
+    template_bucket = api_user = api_pass = api_endpoint = None
     try:
         template_bucket = environ['TEMPLATES_BUCKET']
     except KeyError:
         LOGGER.error('Please set the enviroment variable "TEMPLATES_BUCKET"')
 
+    state_bucket = environ.get('STATE_BUCKET', template_bucket)
+
     try:
         api_user = environ['API_USER']
     except KeyError:
@@ -836,119 +2819,281 @@ def handler(event, context):
     except KeyError:
         LOGGER.error('Please set the enviroment variable "API_ENDPOINT"')
 
-    LOGGER.info("Event: \n" + str(event))
-    LOGGER.info("Context: \n" + str(context))
-    if event['source'] == 'aws.ec2':
-        if event['detail-type'] == 'EC2 Instance State-change Notification':
-            instance_id = event['detail']['instance-id']
-            if event['detail']['state'] == 'running':
-                ec2_filters = [{
-                    "Name": "tag:lambda2icinga",
-                    "Values": ["enabled", "True", "true"]
-                }, {
-                    "Name": "instance-id",
-                    "Values": [instance_id]}]
-                data = get_instance_data(ec2_filters)
-                for metadata in data:
-                    setup_monitoring(metadata,
-                                     template_bucket,
-                                     api_endpoint,
-                                     api_port,
-                                     api_user,
-                                     api_pass)
-            elif event['detail']['state'] == 'terminated':
-                ec2_filters = [{
-                    "Name": "instance-id",
-                    "Values": [instance_id]
-                }]
-                data = get_instance_data(ec2_filters)
-                for metadata in data:
-                    delete_monitoring(metadata,
-                                      api_endpoint,
-                                      api_port,
-                                      api_user,
-                                      api_pass)
-        elif event['detail-type'] == 'AWS API Call via CloudTrail':
-            event_name = event['detail']['eventName']
-            instance_id = event['detail']['requestParameters']['resourcesSet']['items'][0]['resourceId']
-            tags = event['detail']['requestParameters']['tagSet']['items']
-            if event_name == 'CreateTags':
-                for tag in tags:
-                    if tag['key'] in ['lambda2icinga',
-                                      'l2i_host_template',
-                                      'l2i_service_template',
-                                      'l2i_endpoint_template',
-                                      'l2i_zone_template']:
-                        ec2_filters = [{
-                            "Name": "tag:lambda2icinga",
-                            "Values": ["enabled", "True", "true"]
-                        }]
-                        data = get_instance_data(ec2_filters)
-                        for metadata in data:
-                            setup_monitoring(metadata,
-                                             template_bucket,
+    return (template_bucket,
+            state_bucket,
+            api_endpoint,
+            api_port,
+            api_user,
+            api_pass)
+
+
+def log_cold_start():
+    """
+        Log import and init durations on the first invocation of the
+        Lambda container
+    """
+    global COLD_START
+    if COLD_START:
+        LOGGER.info("Cold start: import %.1f ms, init %.1f ms",
+                    IMPORT_DURATION,
+                    INIT_DURATION)
+        record_metric('cold_start.import', IMPORT_DURATION)
+        record_metric('cold_start.init', INIT_DURATION)
+        COLD_START = False
+
+
+def handler(event, context):
+    """
+        AWS Lambda main method
+    """
+    (template_bucket,
+     state_bucket,
+     api_endpoint,
+     api_port,
+     api_user,
+     api_pass) = get_settings()
+
+    # Icinga2 packages may have changed since previous invocation
+    reset_invocation_state()
+    log_cold_start()
+    LOGGER.info("Event: %s", LogPayload(event))
+    LOGGER.debug("Context: %s", LogPayload(lambda: str(context)))
+    sqs_batch = event.get('Records', [{}])[0].get('eventSource') == 'aws:sqs'
+    try:
+        with timed('invocation'):
+            with timed('phase.plan'):
+                if sqs_batch:
+                    plan = plan_batch(event['Records'])
+                else:
+                    plan = new_plan()
+                    add_event_to_plan(plan, event)
+            results = execute_plan(plan,
+                                   context,
+                                   template_bucket,
+                                   state_bucket,
+                                   api_endpoint,
+                                   api_port,
+                                   api_user,
+                                   api_pass)
+            with timed('phase.save'):
+                if FLEET_PACKAGE:
+                    flush_fleet_stage(api_endpoint, api_port, api_user, api_pass)
+                save_instance_state(state_bucket)
+        if sqs_batch:
+            # Requires ReportBatchItemFailures on the event source mapping
+            results['batchItemFailures'] = get_batch_failures(plan, results)
+            if results['batchItemFailures']:
+                LOGGER.warning("%d of %d messages returned for redelivery",
+                               len(results['batchItemFailures']),
+                               len(event['Records']))
+        LOGGER.info("Host stages: %d uploaded, %d unchanged",
+                    get_metric_count('stages.uploaded'),
+                    get_metric_count('stages.unchanged'))
+    finally:
+        flush_metrics('handler')
+    return results
+
+
+def load_deployed_hosts(state_bucket,
+                        api_endpoint,
+                        api_port,
+                        api_user,
+                        api_pass):
+    """
+        Snapshot deployed Icinga2 configuration and recorded instances
+        state. Only packages recorded in instances state (or files of the
+        fleet package) are considered managed and can be deleted
+        Returns dict with recorded (instance ID, state entry) tuples and
+        deployed active stages mapped by hostname, and managed hostnames
+    """
+    recorded = dict((entry['metadata']['hostname'], (instance_id, entry))
+                    for instance_id, entry
+                    in load_instance_state(state_bucket).items())
+    if FLEET_PACKAGE:
+        files = load_fleet_files(api_endpoint, api_port, api_user, api_pass)
+        deployed = dict((conf_path[len('conf.d/'):-len('.conf')], None)
+                        for conf_path in files
+                        if conf_path.endswith('.conf'))
+        managed = set(deployed)
+    else:
+        # Copy, package index is updated as hosts get provisioned
+        deployed = dict(get_package_index(api_endpoint,
+                                          api_port,
+                                          api_user,
+                                          api_pass))
+        managed = set(entry['package'] for _, entry in recorded.values())
+    return {'recorded': recorded, 'deployed': deployed, 'managed': managed}
+
+
+def plan_reconciliation(instances, deployment, full=False):
+    """
+        Compare monitored EC2 instances with deployed Icinga2 configuration.
+        Deployment has to be snapshot before instances are described, hosts
+        provisioned in the meantime are then neither deployed nor deleted
+        Parameters:
+            - instances: monitored hosts metadata mapped by hostname
+            - deployment: snapshot returned by load_deployed_hosts
+            - full: update every deployed host, not only drifted ones
+        Returns dict with create, update and delete hosts metadata mapped
+        by hostname, and stale instances state entries
+    """
+    recorded = deployment['recorded']
+    deployed = deployment['deployed']
+    managed = deployment['managed']
+    create = set(instances) - set(deployed)
+    delete = (managed & set(deployed)) - set(instances)
+    update = set(instances) & set(deployed)
+    if not full:
+        # Keep only hosts which metadata or active stage differ from the
+        # recorded ones
+        update = set(hostname for hostname in update
+                     if hostname not in recorded or
+                     recorded[hostname][1]['metadata'] != instances[hostname] or
+                     (not FLEET_PACKAGE and
+                      recorded[hostname][1]['stage'] != deployed[hostname]))
+    stale = set(recorded) - set(instances) - set(deployed)
+    return {
+        'create': dict((hostname, instances[hostname]) for hostname in create),
+        'update': dict((hostname, instances[hostname]) for hostname in update),
+        'delete': dict((hostname,
+                        recorded[hostname][1]['metadata'] if hostname in recorded
+                        else {'instance_id': None, 'hostname': hostname})
+                       for hostname in delete),
+        'stale': [recorded[hostname][0] for hostname in stale]}
+
+
+def reconcile(event, context):
+    """
+        AWS Lambda reconciliation method, run on schedule to repair missed
+        events. Every monitored EC2 instance is listed once and compared
+        with Icinga2 packages, only differences are applied.
+        Event parameters:
+            - dry_run: only return hosts to create, update and delete
+            - full: re-render every host (e.g. after missed template edits)
+    """
+    (template_bucket,
+     state_bucket,
+     api_endpoint,
+     api_port,
+     api_user,
+     api_pass) = get_settings()
+    reset_invocation_state()
+    log_cold_start()
+    event = event or {}
+    try:
+        return reconcile_fleet(event,
+                               context,
+                               template_bucket,
+                               state_bucket,
+                               api_endpoint,
+                               api_port,
+                               api_user,
+                               api_pass)
+    finally:
+        flush_metrics('reconcile')
+
+
+def reconcile_fleet(event,
+                    context,
+                    template_bucket,
+                    state_bucket,
+                    api_endpoint,
+                    api_port,
+                    api_user,
+                    api_pass):
+    """
+        Apply differences between monitored EC2 instances and Icinga2
+        configuration, see reconcile
+    """
+    with timed('phase.snapshot'):
+        # Taken before discovery, a host provisioned by events while
+        # instances are described must not look gone
+        deployment = load_deployed_hosts(state_bucket,
+                                         api_endpoint,
+                                         api_port,
+                                         api_user,
+                                         api_pass)
+    instances = {}
+    with timed('phase.discovery'):
+        for metadata in get_instance_data([MONITORING_ENABLED_FILTER,
+                                           LIVE_INSTANCE_FILTER]):
+            instances[metadata['hostname']] = metadata
+    with timed('phase.plan'):
+        changes = plan_reconciliation(instances,
+                                      deployment,
+                                      event.get('full', False))
+    LOGGER.info("Reconciliation of %d hosts: %d to create, %d to update, "
+                "%d to delete",
+                len(instances),
+                len(changes['create']),
+                len(changes['update']),
+                len(changes['delete']))
+    if event.get('dry_run'):
+        return {'dry_run': True,
+                'create': sorted(changes['create']),
+                'update': sorted(changes['update']),
+                'delete': sorted(changes['delete'])}
+    for instance_id in changes['stale']:
+        record_instance_state(instance_id, None)
+    results = {}
+    if changes['delete']:
+        results['delete'] = run_provisioning(delete_monitoring,
+                                             [changes['delete'][hostname] for
+                                              hostname in sorted(changes['delete'])],
+                                             context,
                                              api_endpoint,
                                              api_port,
                                              api_user,
                                              api_pass)
-                            # Downtime just created host check
-                            downtime_url = "https://{0}:{1}/v1/actions/schedule-downtime?type=Host&filter=host.name==\"{2}\"".format(api_endpoint,
-                                                                                                                                     api_port,
-                                                                                                                                     metadata['hostname'])
-                            downtime_check(downtime_url,
-                                           api_user,
-                                           api_pass,
-                                           'New host 15 min auto-downtime')
-
-                        break
-            elif event_name == 'DeleteTags':
-                if event['detail']['requestParameters']['tagSet']['items'][0]['key'] == 'lambda2icinga':
-                    ec2_filters = [{
-                        "Name": "instance-id",
-                        "Values": [instance_id]
-                    }]
-                    data = get_instance_data(ec2_filters)
-                    for metadata in data:
-                        delete_monitoring(metadata,
-                                          api_endpoint,
-                                          api_port,
-                                          api_user,
-                                          api_pass)
-                else:
-                    for tag in tags:
-                        if tag['key'] in ['l2i_host_template',
-                                          'l2i_service_template',
-                                          'l2i_endpoint_template',
-                                          'l2i_zone_template']:
-                            ec2_filter = [{
-                                "Name": "instance-id",
-                                "Values": [instance_id]
-                            }]
-                            data = get_instance_data(ec2_filters)
-                            for metadata in data:
-                                setup_monitoring(metadata,
-                                                 template_bucket,
-                                                 api_endpoint,
-                                                 api_port,
-                                                 api_user,
-                                                 api_pass)
-    elif event['Record'][0]['eventSource'] == 'aws.s3':
-        object_key = event['Record'][0]['s3']['object']['key']
-        template_name = object_key.split('/')[-1:]
-        ec2_filters = {}
-        if 'host' in object_key:
-            ec2_filter['tag:l2i_host_template'] = template_name
-        elif 'service' in object_key:
-            ec2_filter['tag:l2i_service_template'] = template_name
-        elif 'endpoint' in object_key:
-            ec2_filter['tag:l2i_endpoint_template'] = template_name
-        elif 'zone' in object_key:
-            ec2_filter['tag:l2i_zone_template'] = template_name
-        data = get_instance_data(ec2_filters)
-        for metadata in data:
-            setup_monitoring(metadata,
-                             template_bucket,
-                             api_endpoint,
-                             api_port,
-                             api_user,
-                             api_pass)
+    setup_hosts = dict(changes['update'])
+    setup_hosts.update(changes['create'])
+    if setup_hosts:
+        results['setup'] = run_provisioning(setup_monitoring,
+                                            [setup_hosts[hostname] for
+                                             hostname in sorted(setup_hosts)],
+                                            context,
+                                            template_bucket,
+                                            api_endpoint,
+                                            api_port,
+                                            api_user,
+                                            api_pass)
+        # Hosts missed by events are new to Icinga2 as well
+        downtime_hosts = set(changes['create']).intersection(results['setup']['succeeded'])
+        if downtime_hosts:
+            if FLEET_PACKAGE:
+                # Hosts have to be uploaded to be downtimed
+                flush_fleet_stage(api_endpoint, api_port, api_user, api_pass)
+            schedule_downtime(downtime_hosts,
+                              NEW_HOST_DOWNTIME,
+                              api_endpoint,
+                              api_port,
+                              api_user,
+                              api_pass,
+                              'New host {0} min auto-downtime'.format(NEW_HOST_DOWNTIME))
+    with timed('phase.save'):
+        if FLEET_PACKAGE:
+            flush_fleet_stage(api_endpoint, api_port, api_user, api_pass)
+        save_instance_state(state_bucket)
+    LOGGER.info("Host stages: %d uploaded, %d unchanged",
+                get_metric_count('stages.uploaded'),
+                get_metric_count('stages.unchanged'))
+    return results
+
+
+def init_container():
+    """
+        Build shared clients during Lambda init phase, so the first
+        invocation does not pay for them
+    """
+    for role_arn, region in get_discovery_targets():
+        # Roles are assumed on first use, not to delay init phase
+        if role_arn is None and region is not None:
+            get_aws_client('ec2', region)
+    get_s3_client()
+    get_api_session()
+
+
+INIT_START = time.time()
+if 'AWS_LAMBDA_FUNCTION_NAME' in environ:
+    init_container()
+INIT_DURATION = (time.time() - INIT_START) * 1000
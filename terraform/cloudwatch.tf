@@ -85,8 +85,48 @@ resource "aws_lambda_permission" "template_bucket_trigger" {
 resource "aws_s3_bucket_notification" "bucket_notification" {
   bucket = "${aws_s3_bucket.s3_tpl_store.id}"
 
+  # Templates only, state objects are saved under lambda2icinga/
   lambda_function {
     lambda_function_arn = "${aws_lambda_function.automagic_lambda2icinga.arn}"
     events              = ["s3:ObjectCreated:*", "s3:ObjectRemoved:*"]
+    filter_prefix       = "host/"
   }
+
+  lambda_function {
+    lambda_function_arn = "${aws_lambda_function.automagic_lambda2icinga.arn}"
+    events              = ["s3:ObjectCreated:*", "s3:ObjectRemoved:*"]
+    filter_prefix       = "service/"
+  }
+
+  lambda_function {
+    lambda_function_arn = "${aws_lambda_function.automagic_lambda2icinga.arn}"
+    events              = ["s3:ObjectCreated:*", "s3:ObjectRemoved:*"]
+    filter_prefix       = "endpoint/"
+  }
+
+  lambda_function {
+    lambda_function_arn = "${aws_lambda_function.automagic_lambda2icinga.arn}"
+    events              = ["s3:ObjectCreated:*", "s3:ObjectRemoved:*"]
+    filter_prefix       = "zone/"
+  }
+}
+
+# === Scheduled reconciliation ===
+resource "aws_cloudwatch_event_rule" "reconcile" {
+  name                = "lambda2icinga-reconcile"
+  description         = "Reconcile Icinga2 configuration with EC2 instances"
+  schedule_expression = "${var.reconcile_schedule}"
+}
+
+resource "aws_cloudwatch_event_target" "reconcile" {
+  rule = "${aws_cloudwatch_event_rule.reconcile.name}"
+  arn  = "${aws_lambda_function.automagic_lambda2icinga_reconcile.arn}"
+}
+
+resource "aws_lambda_permission" "reconcile_trigger" {
+  statement_id  = "AllowExecutionFromCloudWatchReconcileSchedule"
+  action        = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.automagic_lambda2icinga_reconcile.function_name}"
+  principal     = "events.amazonaws.com"
+  source_arn    = "${aws_cloudwatch_event_rule.reconcile.arn}"
 }
@@ -12,6 +12,14 @@ variable "automagic_lambda2icinga_package" {
   default = "../src/pkg/bundle.zip"
 }
 
+variable "discovery_regions" {
+  default = ""
+}
+
+variable "discovery_role_arns" {
+  default = ""
+}
+
 data "aws_iam_policy_document" "lambda2icinga_assume_role" {
   statement {
     actions = [
@@ -51,6 +59,16 @@ data "aws_iam_policy_document" "automagic_lambda2icinga" {
     ]
   }
 
+  statement {
+    actions = [
+      "sts:AssumeRole",
+    ]
+
+    resources = [
+      "*",
+    ]
+  }
+
   statement {
     actions = [
       "s3:GetObject",
@@ -63,6 +81,16 @@ data "aws_iam_policy_document" "automagic_lambda2icinga" {
       "${aws_s3_bucket.s3_tpl_store.arn}/*",
     ]
   }
+
+  statement {
+    actions = [
+      "s3:PutObject",
+    ]
+
+    resources = [
+      "${aws_s3_bucket.s3_tpl_store.arn}/lambda2icinga/*",
+    ]
+  }
 }
 
 resource "aws_iam_role_policy" "automagic_lambda2icinga" {
@@ -78,16 +106,44 @@ resource "aws_lambda_function" "automagic_lambda2icinga" {
   role             = "${aws_iam_role.lambda2icinga_assume_role.arn}"
   handler          = "index.handler"
   source_code_hash = "${base64sha256(file("${var.automagic_lambda2icinga_package}"))}"
-  runtime          = "python3.6"
+  runtime          = "python3.12"
   timeout          = 90
 
   environment {
     variables = {
-      TEMPLATES_BUCKET = "${var.bucket_name}"
-      API_ENDPOINT     = "${var.api_endpoint}"
-      API_PORT         = "${var.api_port}"
-      API_USER         = "${var.api_user}"
-      API_PASS         = "${var.api_password}"
+      TEMPLATES_BUCKET    = "${var.bucket_name}"
+      API_ENDPOINT        = "${var.api_endpoint}"
+      API_PORT            = "${var.api_port}"
+      API_USER            = "${var.api_user}"
+      API_PASS            = "${var.api_password}"
+      DISCOVERY_REGIONS   = "${var.discovery_regions}"
+      DISCOVERY_ROLE_ARNS = "${var.discovery_role_arns}"
+    }
+  }
+}
+
+variable "reconcile_schedule" {
+  default = "rate(1 hour)"
+}
+
+resource "aws_lambda_function" "automagic_lambda2icinga_reconcile" {
+  filename         = "${var.automagic_lambda2icinga_package}"
+  function_name    = "automagic_lambda2icinga_reconcile"
+  role             = "${aws_iam_role.lambda2icinga_assume_role.arn}"
+  handler          = "index.reconcile"
+  source_code_hash = "${base64sha256(file("${var.automagic_lambda2icinga_package}"))}"
+  runtime          = "python3.12"
+  timeout          = 900
+
+  environment {
+    variables = {
+      TEMPLATES_BUCKET    = "${var.bucket_name}"
+      API_ENDPOINT        = "${var.api_endpoint}"
+      API_PORT            = "${var.api_port}"
+      API_USER            = "${var.api_user}"
+      API_PASS            = "${var.api_password}"
+      DISCOVERY_REGIONS   = "${var.discovery_regions}"
+      DISCOVERY_ROLE_ARNS = "${var.discovery_role_arns}"
     }
   }
 }
@@ -0,0 +1,162 @@
+"""
+    Unit tests of provisioning plan coalescing and SQS batch item failures
+"""
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import index  # noqa: E402
+
+
+def state_event(instance_id, state, time):
+    """
+        Return EventBridge EC2 state-change event
+    """
+    return {'source': 'aws.ec2',
+            'detail-type': 'EC2 Instance State-change Notification',
+            'time': time,
+            'detail': {'instance-id': instance_id, 'state': state}}
+
+
+def sqs_record(message_id, event):
+    """
+        Return SQS record delivering the event
+    """
+    return {'eventSource': 'aws:sqs',
+            'messageId': message_id,
+            'body': json.dumps(event)}
+
+
+def run_results(instances, failed=(), skipped=(), incomplete=False):
+    """
+        Return run_provisioning results for hosts mapped to instance IDs
+    """
+    return {'succeeded': [hostname for hostname in instances
+                          if hostname not in failed and hostname not in skipped],
+            'failed': dict((hostname, 'error') for hostname in failed),
+            'skipped': list(skipped),
+            'instances': dict(instances),
+            'incomplete': incomplete}
+
+
+class PlanInstanceTest(unittest.TestCase):
+
+    def test_setup_kinds_are_merged(self):
+        plan = index.new_plan()
+        index.plan_instance(plan, 'i-1', 'setup', ['host'])
+        index.plan_instance(plan, 'i-1', 'setup', ['service'])
+        self.assertEqual(plan['instances']['i-1']['kinds'], {'host', 'service'})
+
+    def test_setup_of_all_kinds_wins(self):
+        plan = index.new_plan()
+        index.plan_instance(plan, 'i-1', 'setup', ['host'])
+        index.plan_instance(plan, 'i-1', 'setup')
+        index.plan_instance(plan, 'i-1', 'setup', ['service'])
+        self.assertIsNone(plan['instances']['i-1']['kinds'])
+
+    def test_downtime_and_target_are_kept(self):
+        plan = index.new_plan()
+        index.plan_instance(plan, 'i-1', 'setup', downtime=True,
+                            target=(None, 'eu-west-1'))
+        index.plan_instance(plan, 'i-1', 'setup', ['host'])
+        entry = plan['instances']['i-1']
+        self.assertTrue(entry['downtime'])
+        self.assertEqual(entry['target'], (None, 'eu-west-1'))
+
+    def test_last_action_wins(self):
+        plan = index.new_plan()
+        index.plan_instance(plan, 'i-1', 'delete')
+        index.plan_instance(plan, 'i-1', 'setup')
+        self.assertEqual(plan['instances']['i-1']['action'], 'setup')
+
+    def test_terminate_is_final(self):
+        plan = index.new_plan()
+        index.plan_instance(plan, 'i-1', 'terminate', message_id='m1')
+        index.plan_instance(plan, 'i-1', 'setup', message_id='m2')
+        self.assertEqual(plan['instances']['i-1']['action'], 'terminate')
+        self.assertEqual(plan['messages']['i-1'], {'m1', 'm2'})
+
+
+class PlanBatchTest(unittest.TestCase):
+
+    def test_events_are_applied_in_occurrence_order(self):
+        plan = index.plan_batch([
+            sqs_record('m1', state_event('i-1', 'terminated',
+                                         '2026-01-01T00:00:02Z')),
+            sqs_record('m2', state_event('i-1', 'running',
+                                         '2026-01-01T00:00:01Z')),
+            sqs_record('m3', state_event('i-2', 'running',
+                                         '2026-01-01T00:00:03Z'))])
+        self.assertEqual(plan['instances']['i-1']['action'], 'terminate')
+        self.assertEqual(plan['instances']['i-2']['action'], 'setup')
+        self.assertEqual(plan['messages'], {'i-1': {'m1', 'm2'},
+                                            'i-2': {'m3'}})
+
+    def test_template_updates_are_coalesced(self):
+        template_event = {'Records': [{'eventSource': 'aws:s3',
+                                       'eventTime': '2026-01-01T00:00:00Z',
+                                       's3': {'bucket': {'name': 'templates'},
+                                              'object': {'key': 'host/web'}}}]}
+        plan = index.plan_batch([sqs_record('m1', template_event),
+                                 sqs_record('m2', template_event)])
+        self.assertEqual(plan['templates'], {('host', 'web')})
+        self.assertEqual(plan['messages'][('host', 'web')], {'m1', 'm2'})
+
+    def test_malformed_messages_are_skipped(self):
+        plan = index.plan_batch([
+            {'eventSource': 'aws:sqs', 'messageId': 'm1', 'body': '{'},
+            sqs_record('m2', state_event('i-1', 'running',
+                                         '2026-01-01T00:00:00Z'))])
+        self.assertEqual(list(plan['instances']), ['i-1'])
+
+
+class BatchFailuresTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = index.plan_batch([
+            sqs_record('m1', state_event('i-1', 'running',
+                                         '2026-01-01T00:00:01Z')),
+            sqs_record('m2', state_event('i-2', 'running',
+                                         '2026-01-01T00:00:02Z')),
+            sqs_record('m3', state_event('i-3', 'terminated',
+                                         '2026-01-01T00:00:03Z'))])
+
+    def test_succeeded_batch_has_no_failures(self):
+        results = {'setup': run_results({'h1': 'i-1', 'h2': 'i-2'}),
+                   'delete': run_results({'h3': 'i-3'})}
+        self.assertEqual(index.get_batch_failures(self.plan, results), [])
+
+    def test_failed_and_skipped_hosts_are_returned(self):
+        results = {'setup': run_results({'h1': 'i-1', 'h2': 'i-2'},
+                                        failed=['h1']),
+                   'delete': run_results({'h3': 'i-3'}, skipped=['h3'])}
+        self.assertEqual(index.get_batch_failures(self.plan, results),
+                         [{'itemIdentifier': 'm1'}, {'itemIdentifier': 'm3'}])
+
+    def test_hosts_not_reached_before_deadline_are_returned(self):
+        results = {'setup': run_results({'h1': 'i-1'}, incomplete=True),
+                   'delete': run_results({'h3': 'i-3'})}
+        self.assertEqual(index.get_batch_failures(self.plan, results),
+                         [{'itemIdentifier': 'm2'}])
+
+    def test_failed_template_host_returns_template_messages(self):
+        index.add_event_to_plan(
+            self.plan,
+            {'Records': [{'eventSource': 'aws:s3',
+                          's3': {'bucket': {'name': 'templates'},
+                                 'object': {'key': 'service/web'}}}]},
+            'm4')
+        results = {'setup': run_results({'h1': 'i-1', 'h2': 'i-2',
+                                         'web': 'i-9'},
+                                        failed=['web']),
+                   'delete': run_results({'h3': 'i-3'})}
+        self.assertEqual(index.get_batch_failures(self.plan, results),
+                         [{'itemIdentifier': 'm4'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
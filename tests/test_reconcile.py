@@ -0,0 +1,136 @@
+"""
+    Unit tests of reconciliation planning, and of reconciliation against
+    the in-memory S3 and fake Icinga2 master of the benchmark
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'tools'))
+
+import urllib3  # noqa: E402
+
+import benchmark  # noqa: E402
+from benchmark import FakeAws, FakeIcinga, index  # noqa: E402
+
+
+def recorded(hostname, instance_id, stage, metadata=None):
+    """
+        Return recorded (instance ID, state entry) tuple of the host
+    """
+    return (instance_id,
+            {'metadata': metadata or {'hostname': hostname,
+                                      'instance_id': instance_id},
+             'package': hostname,
+             'stage': stage,
+             'digest': None})
+
+
+class PlanReconciliationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.instances = dict((hostname, {'hostname': hostname,
+                                          'instance_id': instance_id})
+                              for hostname, instance_id
+                              in (('web', 'i-1'), ('db', 'i-2'), ('new', 'i-3')))
+        self.deployment = {
+            'recorded': {'web': recorded('web', 'i-1', 'web-1'),
+                         'db': recorded('db', 'i-2', 'db-1'),
+                         'gone': recorded('gone', 'i-4', 'gone-1'),
+                         'lost': recorded('lost', 'i-5', 'lost-1')},
+            'deployed': {'web': 'web-1',
+                         'db': 'db-2',
+                         'gone': 'gone-1',
+                         'manual': 'manual-1'},
+            'managed': {'web', 'db', 'gone', 'lost'}}
+
+    def test_differences_are_planned(self):
+        changes = index.plan_reconciliation(self.instances, self.deployment)
+        self.assertEqual(sorted(changes['create']), ['new'])
+        # Active stage of db differs from the recorded one
+        self.assertEqual(sorted(changes['update']), ['db'])
+        # Packages not recorded in instances state are never deleted
+        self.assertEqual(sorted(changes['delete']), ['gone'])
+        self.assertEqual(changes['delete']['gone']['instance_id'], 'i-4')
+        self.assertEqual(changes['stale'], ['i-5'])
+
+    def test_full_reconciliation_updates_every_deployed_host(self):
+        changes = index.plan_reconciliation(self.instances, self.deployment,
+                                            full=True)
+        self.assertEqual(sorted(changes['update']), ['db', 'web'])
+
+    def test_changed_metadata_is_updated(self):
+        self.instances['web']['address'] = '10.0.0.1'
+        changes = index.plan_reconciliation(self.instances, self.deployment)
+        self.assertEqual(sorted(changes['update']), ['db', 'web'])
+
+
+class ReconcileFleetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        cls.icinga = FakeIcinga().start()
+        cls.api_port = str(cls.icinga.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.icinga.stop()
+
+    def setUp(self):
+        self.icinga.reset()
+        self.aws = FakeAws(2)
+        self.aws.install()
+        benchmark.reset_index()
+
+    def reconcile(self, event):
+        index.reset_invocation_state()
+        return index.reconcile_fleet(event,
+                                     None,
+                                     'templates',
+                                     'state',
+                                     '127.0.0.1',
+                                     self.api_port,
+                                     'user',
+                                     'pass')
+
+    def test_missing_hosts_are_created(self):
+        results = self.reconcile({})
+        self.assertEqual(sorted(results['setup']['succeeded']),
+                         ['bench-00000', 'bench-00001'])
+        self.assertEqual(sorted(self.icinga.packages),
+                         ['bench-00000', 'bench-00001'])
+        self.assertEqual(self.reconcile({'dry_run': True}),
+                         {'dry_run': True, 'create': [], 'update': [],
+                          'delete': []})
+
+    def test_gone_hosts_are_deleted(self):
+        self.reconcile({})
+        self.aws.hosts = 1
+        results = self.reconcile({})
+        self.assertEqual(results['delete']['succeeded'], ['bench-00001'])
+        self.assertEqual(sorted(self.icinga.packages), ['bench-00000'])
+
+    def test_hosts_provisioned_during_discovery_are_kept(self):
+        self.reconcile({})
+        describe_instances = self.aws.describe_instances
+
+        def provision_during_discovery(context, **kwargs):
+            # Another container provisions a launched instance which the
+            # ongoing describe does not list yet
+            index.setup_monitoring(index.get_instance_metadata(
+                benchmark.make_instance(2)),
+                'templates', '127.0.0.1', self.api_port, 'user', 'pass')
+            index.save_instance_state('state')
+            return describe_instances(context, **kwargs)
+
+        self.aws.describe_instances = provision_during_discovery
+        self.aws.install()
+        results = self.reconcile({})
+        self.assertNotIn('delete', results)
+        self.assertIn('bench-00002', self.icinga.packages)
+
+
+if __name__ == '__main__':
+    unittest.main()
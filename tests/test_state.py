@@ -0,0 +1,101 @@
+"""
+    Unit tests of instances state snapshot conditional writes, against the
+    in-memory S3 of the benchmark
+"""
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'tools'))
+
+import benchmark  # noqa: E402
+from benchmark import FakeAws, index  # noqa: E402
+
+BUCKET = 'state'
+
+
+def host_metadata(number, host_template='default'):
+    """
+        Return recorded metadata of generated host
+    """
+    metadata = {'hostname': 'bench-{0:05d}'.format(number),
+                'instance_id': benchmark.instance_id(number),
+                'address': '10.0.0.{0}'.format(number)}
+    for kind in index.HOST_OBJECT_KINDS:
+        metadata[index.TEMPLATE_TAGS[kind]] = 'default'
+    metadata['l2i_host_template'] = host_template
+    return metadata
+
+
+class InstanceStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAws(0)
+        self.aws.install()
+        benchmark.reset_index()
+
+    def stored(self):
+        body, _ = self.aws.objects[index.INSTANCE_STATE_KEY]
+        return json.loads(body.decode('utf-8'))['instances']
+
+    def write_concurrently(self, instances):
+        """
+            Replace snapshot like another Lambda container would
+        """
+        self.aws.versions += 1
+        self.aws.objects[index.INSTANCE_STATE_KEY] = \
+            (json.dumps({'instances': instances}).encode('utf-8'),
+             '"concurrent{0}"'.format(self.aws.versions))
+
+    def test_missing_snapshot_is_created(self):
+        index.record_instance_state('i-1', host_metadata(1))
+        index.save_instance_state(BUCKET)
+        self.assertEqual(list(self.stored()), ['i-1'])
+        self.assertEqual(self.aws.calls['PutObject'], 1)
+
+    def test_unchanged_state_is_not_written(self):
+        index.load_instance_state(BUCKET)
+        index.save_instance_state(BUCKET)
+        self.assertNotIn('PutObject', self.aws.calls)
+
+    def test_changes_are_merged_into_concurrent_update(self):
+        index.record_instance_state('i-1', host_metadata(1))
+        index.record_instance_state('i-2', host_metadata(2))
+        index.save_instance_state(BUCKET)
+        # Next invocation loads the snapshot, another container then
+        # records a new instance
+        index.reset_invocation_state()
+        index.load_instance_state(BUCKET)
+        instances = self.stored()
+        instances['i-3'] = {'metadata': host_metadata(3)}
+        self.write_concurrently(instances)
+        index.record_instance_state('i-1', None)
+        index.record_instance_state('i-4', host_metadata(4))
+        index.save_instance_state(BUCKET)
+        self.assertEqual(sorted(self.stored()), ['i-2', 'i-3', 'i-4'])
+        self.assertEqual(self.aws.calls['PutObject'], 3)
+
+    def test_snapshot_created_concurrently_is_merged(self):
+        index.load_instance_state(BUCKET)
+        self.write_concurrently({'i-2': {'metadata': host_metadata(2)}})
+        index.record_instance_state('i-1', host_metadata(1))
+        index.save_instance_state(BUCKET)
+        self.assertEqual(sorted(self.stored()), ['i-1', 'i-2'])
+
+    def test_template_lookup_uses_recorded_metadata(self):
+        self.assertIsNone(index.get_indexed_hosts(BUCKET, 'host', 'web'))
+        index.record_instance_state('i-1', host_metadata(1, 'web'))
+        index.record_instance_state('i-2', host_metadata(2))
+        index.save_instance_state(BUCKET)
+        index.reset_invocation_state()
+        self.assertEqual(index.get_indexed_hosts(BUCKET, 'host', 'web'),
+                         {'bench-00001'})
+        index.record_instance_state('i-2', host_metadata(2, 'web'))
+        self.assertEqual(index.get_indexed_hosts(BUCKET, 'host', 'web'),
+                         {'bench-00001', 'bench-00002'})
+
+
+if __name__ == '__main__':
+    unittest.main()
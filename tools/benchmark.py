@@ -0,0 +1,373 @@
+"""
+    Benchmark lambda2icinga render and provisioning hot paths offline.
+
+    EC2 and S3 calls are answered by botocore event stubs serving generated
+    instances and templates from the repository templates/ directory,
+    Icinga2 API calls are served by tools/fake_icinga.py. Results are
+    printed as JSON, optionally compared against previous results.
+
+    Usage:
+        python tools/benchmark.py
+        python tools/benchmark.py --sizes 10,100,1000,10000 -o results.json
+        python tools/benchmark.py --baseline results.json --tolerance 0.25
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(TOOLS_DIR, '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+sys.path.insert(0, TOOLS_DIR)
+
+# index reads its settings on import
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('TEMPLATES_BUCKET', 'benchmark-templates')
+os.environ.setdefault('API_USER', 'benchmark')
+os.environ.setdefault('API_PASS', 'benchmark')
+os.environ.setdefault('API_ENDPOINT', '127.0.0.1')
+# EMF metrics documents would be mixed into JSON results
+os.environ.setdefault('METRICS_NAMESPACE', '')
+
+import urllib3  # noqa: E402
+from botocore.awsrequest import AWSResponse  # noqa: E402
+from botocore.response import StreamingBody  # noqa: E402
+
+import index  # noqa: E402
+from fake_icinga import FakeIcinga  # noqa: E402
+
+
+def instance_id(number):
+    """
+        Return EC2 instance ID of generated host
+    """
+    return 'i-{0:017x}'.format(number)
+
+
+def make_instance(number):
+    """
+        Return describe_instances description of generated host
+    """
+    return {'InstanceId': instance_id(number),
+            'PrivateIpAddress': '10.{0}.{1}.{2}'.format(number // 65536 % 256,
+                                                         number // 256 % 256,
+                                                         number % 256),
+            'Tags': [{'Key': 'Name', 'Value': 'bench-{0:05d}'.format(number)},
+                     {'Key': 'lambda2icinga', 'Value': 'true'}]}
+
+
+class FakeAws(object):
+    """
+        Answer EC2 DescribeInstances and S3 object calls through botocore
+        before-call events, so no request leaves the process. S3 object
+        conditions (If-Match/If-None-Match) are honored like by S3
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.objects = {}
+        self.calls = {}
+        self.versions = 0
+        for kind in os.listdir(os.path.join(ROOT_DIR, 'templates')):
+            kind_dir = os.path.join(ROOT_DIR, 'templates', kind)
+            for name in os.listdir(kind_dir):
+                with open(os.path.join(kind_dir, name), 'rb') as template:
+                    self.objects['{0}/{1}'.format(kind, name.rsplit('.', 1)[0])] = \
+                        (template.read(), '"{0}"'.format(name))
+
+    def install(self):
+        """
+            Register stubs on index shared clients
+        """
+        index.AWS_CLIENTS.clear()
+        ec2 = index.get_aws_client('ec2', os.environ['AWS_DEFAULT_REGION'])
+        s3 = index.get_s3_client()
+        for client in (ec2, s3):
+            client.meta.events.register('before-parameter-build',
+                                        self.keep_params)
+        ec2.meta.events.register('before-call.ec2.DescribeInstances',
+                                 self.describe_instances)
+        s3.meta.events.register('before-call.s3.GetObject', self.get_object)
+        s3.meta.events.register('before-call.s3.PutObject', self.put_object)
+
+    @staticmethod
+    def keep_params(params, context, **kwargs):
+        # before-call only receives serialized request, keep API parameters
+        context['api_params'] = dict(params)
+
+    def count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def describe_instances(self, context, **kwargs):
+        params = context['api_params']
+        self.count('DescribeInstances')
+        wanted = None
+        for ec2_filter in params.get('Filters', []):
+            if ec2_filter['Name'] == 'instance-id':
+                wanted = set(ec2_filter['Values'])
+        numbers = [number for number in range(self.hosts)
+                   if wanted is None or instance_id(number) in wanted]
+        start = int(params.get('NextToken') or 0)
+        end = start + params.get('MaxResults', 1000)
+        response = {'Reservations': [{'Instances': [make_instance(number)
+                                                    for number in numbers[start:end]]}]}
+        if end < len(numbers):
+            response['NextToken'] = str(end)
+        return AWSResponse(None, 200, {}, None), response
+
+    def get_object(self, context, **kwargs):
+        params = context['api_params']
+        self.count('GetObject')
+        try:
+            body, etag = self.objects[params['Key']]
+        except KeyError:
+            return AWSResponse(None, 404, {}, None), \
+                {'Error': {'Code': 'NoSuchKey', 'Message': params['Key']}}
+        if params.get('IfNoneMatch') == etag:
+            return AWSResponse(None, 304, {}, None), \
+                {'Error': {'Code': '304', 'Message': 'Not Modified'}}
+        return AWSResponse(None, 200, {}, None), \
+            {'Body': StreamingBody(io.BytesIO(body), len(body)), 'ETag': etag}
+
+    def put_object(self, context, **kwargs):
+        params = context['api_params']
+        self.count('PutObject')
+        body = params['Body']
+        if hasattr(body, 'read'):
+            # botocore wraps bytes bodies in file-like object
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        current = self.objects.get(params['Key'])
+        if (params.get('IfNoneMatch') == '*' and current is not None) or \
+                ('IfMatch' in params and
+                 (current is None or current[1] != params['IfMatch'])):
+            return AWSResponse(None, 412, {}, None), \
+                {'Error': {'Code': 'PreconditionFailed',
+                           'Message': params['Key']}}
+        self.versions += 1
+        etag = '"v{0}"'.format(self.versions)
+        self.objects[params['Key']] = (body, etag)
+        return AWSResponse(None, 200, {}, None), {'ETag': etag}
+
+
+def reset_index():
+    """
+        Forget every cache kept by index between Lambda invocations
+    """
+    index.TEMPLATE_CACHE.clear()
+    index.RENDER_CACHE.clear()
+    index.STAGE_HASHES.clear()
+    index.FLEET_FILES.update({'stage': None, 'files': {}, 'lineage': []})
+    index.SERVICE_RULES.update({'stage': None, 'files': {}, 'lineage': [],
+                                'synced': {}})
+    index.INSTANCE_STATE.update({'instances': None, 'reverse': None,
+                                 'etag': None, 'checked': False,
+                                 'pending': {}})
+    index.reset_invocation_state()
+
+
+def measure(name, hosts, function, repeat):
+    """
+        Run function repeat times, return result with the best run
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {'benchmark': name,
+            'hosts': hosts,
+            'seconds': round(best, 6),
+            'per_host_ms': round(best * 1000 / max(hosts, 1), 6)}
+
+
+def bench_parse(repeat):
+    """
+        Measure YAML parse and validation of every repository template
+    """
+    results = []
+    aws = FakeAws(0)
+    for key, (body, _) in sorted(aws.objects.items()):
+        def parse():
+            for _ in range(100):
+                index.parse_template(key, body)
+        result = measure('parse.{0}'.format(key), 100, parse, repeat)
+        results.append(result)
+    return results
+
+
+def bench_render(hosts, repeat):
+    """
+        Measure rendering of every object kind for generated hosts
+    """
+    aws = FakeAws(0)
+    templates = dict((kind, index.parse_template('{0}/default'.format(kind),
+                                                 aws.objects['{0}/default'.format(kind)][0])
+                      if '{0}/default'.format(kind) in aws.objects else None)
+                     for kind in index.HOST_OBJECT_KINDS)
+    metadata = [index.get_instance_metadata(make_instance(number))
+                for number in range(hosts)]
+    results = []
+    for kind in index.HOST_OBJECT_KINDS:
+        def render():
+            for host in metadata:
+                index.render_object_block(kind, host, templates[kind])
+
+        def render_memoized():
+            index.RENDER_CACHE.clear()
+            for host in metadata:
+                index.render_host_object(kind, host, templates[kind], kind)
+        results.append(measure('render.{0}'.format(kind), hosts, render, repeat))
+        results.append(measure('render.{0}.memoized'.format(kind),
+                               hosts,
+                               render_memoized,
+                               repeat))
+    return results
+
+
+def bench_setup(hosts, repeat, icinga):
+    """
+        Measure setup_monitoring of generated hosts through provisioning
+        worker pool, with and without already uploaded configuration
+    """
+    aws = FakeAws(hosts)
+    aws.install()
+    metadata = [index.get_instance_metadata(make_instance(number))
+                for number in range(hosts)]
+    api = (icinga.host, icinga.port, 'benchmark', 'benchmark')
+    results = []
+
+    def setup():
+        index.reset_invocation_state()
+        index.run_provisioning(index.setup_monitoring, metadata, None,
+                               os.environ['TEMPLATES_BUCKET'], *api)
+
+    def cold_setup():
+        icinga.reset()
+        reset_index()
+        setup()
+
+    results.append(measure('setup_monitoring.new', hosts, cold_setup, repeat))
+    results.append(measure('setup_monitoring.unchanged', hosts, setup, repeat))
+    return results
+
+
+def bench_handler(hosts, repeat, icinga):
+    """
+        Measure handler throughput for SQS batch of instance launches
+    """
+    aws = FakeAws(hosts)
+    aws.install()
+    records = [{'eventSource': 'aws:sqs',
+                'messageId': str(number),
+                'body': json.dumps({'source': 'aws.ec2',
+                                    'detail-type': 'EC2 Instance State-change Notification',
+                                    'time': '2026-01-01T00:00:00Z',
+                                    'detail': {'instance-id': instance_id(number),
+                                               'state': 'running'}})}
+               for number in range(hosts)]
+    event = {'Records': records}
+
+    def handle():
+        icinga.reset()
+        reset_index()
+        index.handler(event, None)
+
+    result = measure('handler.sqs_launch', hosts, handle, repeat)
+    result['api'] = icinga.stats()
+    result['aws_calls'] = dict(aws.calls)
+    return [result]
+
+
+def compare(results, baseline, tolerance):
+    """
+        Return benchmarks slower than baseline by more than tolerance
+    """
+    previous = dict(((item['benchmark'], item['hosts']), item['seconds'])
+                    for item in baseline['results'])
+    regressions = []
+    for item in results:
+        before = previous.get((item['benchmark'], item['hosts']))
+        if before and item['seconds'] > before * (1 + tolerance):
+            regressions.append({'benchmark': item['benchmark'],
+                                'hosts': item['hosts'],
+                                'baseline': before,
+                                'seconds': item['seconds']})
+    return regressions
+
+
+def main():
+    """
+        Run benchmarks
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='comma separated fleet sizes (default: 10,100,1000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, best run is reported')
+    parser.add_argument('-o', '--output', help='write JSON results to file')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against baseline (default: 0.2)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='fake Icinga2 API latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of fake Icinga2 API 500 errors')
+    parser.add_argument('--validation-delay', type=float, default=0.0,
+                        help='seconds before uploaded stage becomes active')
+    parser.add_argument('--reload-errors', action='store_true',
+                        help='fake Icinga2 API fails while stage is validated')
+    args = parser.parse_args()
+    # Missing endpoint/zone templates and self-signed certificate of the
+    # fake Icinga2 master would flood the output
+    logging.disable(logging.ERROR)
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    icinga = FakeIcinga(latency=args.latency,
+                        error_rate=args.error_rate,
+                        validation_delay=args.validation_delay,
+                        reload_errors=args.reload_errors,
+                        seed=0).start()
+    os.environ['API_PORT'] = str(icinga.port)
+    try:
+        results = bench_parse(args.repeat)
+        for hosts in [int(size) for size in args.sizes.split(',')]:
+            results.extend(bench_render(hosts, args.repeat))
+            results.extend(bench_setup(hosts, args.repeat, icinga))
+            results.extend(bench_handler(hosts, args.repeat, icinga))
+    finally:
+        icinga.stop()
+
+    report = {'python': platform.python_version(),
+              'concurrency': index.PROVISION_CONCURRENCY,
+              'icinga': {'latency': args.latency,
+                         'error_rate': args.error_rate,
+                         'validation_delay': args.validation_delay,
+                         'reload_errors': args.reload_errors},
+              'results': results}
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            report['regressions'] = compare(results,
+                                            json.load(baseline),
+                                            args.tolerance)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + '\n')
+    else:
+        print(output)
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
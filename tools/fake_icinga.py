@@ -0,0 +1,375 @@
+"""
+    In-process fake of the Icinga2 API endpoints used by lambda2icinga.
+
+    Serves configuration packages, stages, files and schedule-downtime
+    actions over HTTPS on localhost, keeping all state in memory. Self-signed
+    certificate is generated with openssl on start.
+
+    Slow or failing master is simulated with per-request latency, random
+    500 errors, 429 responses above request rate limit and stage validation
+    delay. Uploaded stage becomes active only once validated; with
+    reload_errors requests answered during validation fail with 503, like
+    Icinga2 master reloading its configuration.
+
+    Usage:
+        server = FakeIcinga(latency=0.05, error_rate=0.01)
+        server.start()
+        ... point API_ENDPOINT/API_PORT at server.host/server.port ...
+        server.stop()
+
+        python tools/fake_icinga.py --port 5665 --latency 0.05 \
+            --validation-delay 2 --reload-errors
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import unquote
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+        HTTP server handling every connection in its own thread
+    """
+    daemon_threads = True
+
+
+class FakeIcinga(object):
+    """
+        Fake Icinga2 master keeping configuration packages in memory
+    """
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=0,
+                 latency=0.0,
+                 jitter=0.0,
+                 error_rate=0.0,
+                 rate_limit=0,
+                 validation_delay=0.0,
+                 reload_errors=False,
+                 seed=None):
+        """
+            Parameters:
+                - latency: seconds added to every response
+                - jitter: maximum random seconds added on top of latency
+                - error_rate: probability of answering with 500 error
+                - rate_limit: requests per second answered before
+                              responding with 429 (0 disables the limit)
+                - validation_delay: seconds before uploaded stage is active
+                - reload_errors: answer with 503 while any stage validates
+                - seed: random generator seed for reproducible runs
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.validation_delay = validation_delay
+        self.reload_errors = reload_errors
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Package name mapped to {'active-stage': name, 'stages': {name: files}}
+        self.packages = {}
+        # Uploaded stages as (activation time, package, stage)
+        self.validating = []
+        self.downtimes = []
+        self.requests = 0
+        self.statuses = {}
+        self.window = (0, 0)
+        self.server = None
+        self.thread = None
+        self.cert_dir = None
+
+    def start(self):
+        """
+            Start serving in background thread
+        """
+        self.cert_dir = tempfile.mkdtemp(prefix='fake-icinga-')
+        cert = os.path.join(self.cert_dir, 'cert.pem')
+        key = os.path.join(self.cert_dir, 'key.pem')
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                               '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                               '-keyout', key, '-out', cert],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        fake = self
+
+        class Handler(RequestHandler):
+            icinga = fake
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.server.socket = context.wrap_socket(self.server.socket,
+                                                 server_side=True)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+            Stop serving and remove generated certificate
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.cert_dir is not None:
+            shutil.rmtree(self.cert_dir, ignore_errors=True)
+            self.cert_dir = None
+
+    def reset(self):
+        """
+            Forget every package, downtime and request count
+        """
+        with self.lock:
+            self.packages.clear()
+            del self.validating[:]
+            del self.downtimes[:]
+            self.requests = 0
+            self.statuses.clear()
+            self.window = (0, 0)
+
+    def stats(self):
+        """
+            Return number of requests and responses by status code
+        """
+        with self.lock:
+            return {'requests': self.requests,
+                    'statuses': dict(self.statuses)}
+
+    def activate_validated(self, now):
+        """
+            Activate stages which validation delay has passed
+        """
+        pending = []
+        for due, name, stage in self.validating:
+            package = self.packages.get(name)
+            if package is None or stage not in package['stages']:
+                continue
+            if due <= now:
+                package['active-stage'] = stage
+            else:
+                pending.append((due, name, stage))
+        self.validating[:] = pending
+
+    def injected_error(self, now):
+        """
+            Return simulated failure response for the request, or None
+        """
+        if self.rate_limit:
+            second, count = self.window
+            if int(now) != second:
+                second, count = int(now), 0
+            self.window = (second, count + 1)
+            if count >= self.rate_limit:
+                return 429, {'error': 429, 'status': 'Too many requests'}
+        if self.reload_errors and self.validating:
+            return 503, {'error': 503, 'status': 'Configuration reload in progress'}
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 500, {'error': 500, 'status': 'Injected error'}
+        return None
+
+    def handle(self, method, path, body):
+        """
+            Dispatch API request. Returns (status, payload) tuple, payload
+            is JSON serializable result or raw bytes of configuration file
+        """
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            status, payload = self.dispatch(method, path, body)
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return status, payload
+
+    def dispatch(self, method, path, body):
+        """
+            Route API request to its endpoint handler
+        """
+        now = time.time()
+        self.activate_validated(now)
+        error = self.injected_error(now)
+        if error is not None:
+            return error
+        parts = [unquote(part) for part in path.split('?')[0].strip('/').split('/')]
+        if parts[:3] == ['v1', 'config', 'packages']:
+            return self.handle_package(method, parts[3:])
+        if parts[:3] == ['v1', 'config', 'stages']:
+            return self.handle_stage(method, parts[3:], body)
+        if parts[:3] == ['v1', 'config', 'files'] and method == 'GET':
+            return self.handle_file(parts[3:])
+        if parts == ['v1', 'actions', 'schedule-downtime'] and method == 'POST':
+            return self.handle_downtime(body)
+        return 404, {'error': 404, 'status': 'Not found'}
+
+    def handle_package(self, method, parts):
+        """
+            List, create or delete configuration packages
+        """
+        if not parts and method == 'GET':
+            return 200, {'results': [{'name': name,
+                                      'active-stage': package['active-stage'],
+                                      'stages': sorted(package['stages'])}
+                                     for name, package in sorted(self.packages.items())]}
+        if len(parts) != 1:
+            return 404, {'error': 404, 'status': 'Not found'}
+        name = parts[0]
+        if method == 'POST':
+            self.packages.setdefault(name, {'active-stage': None, 'stages': {}})
+            return 200, {'results': [{'code': 200, 'package': name,
+                                      'status': 'Created package.'}]}
+        if method == 'DELETE':
+            if self.packages.pop(name, None) is None:
+                return 500, {'results': [{'code': 500, 'package': name,
+                                          'status': 'Failed to delete package.'}]}
+            return 200, {'results': [{'code': 200, 'package': name,
+                                      'status': 'Deleted package.'}]}
+        return 404, {'error': 404, 'status': 'Not found'}
+
+    def handle_stage(self, method, parts, body):
+        """
+            Upload stage (activated once validated) or list files of a stage
+        """
+        package = self.packages.get(parts[0]) if parts else None
+        if package is None:
+            return 404, {'error': 404, 'status': 'Package not found'}
+        if len(parts) == 1 and method == 'POST':
+            files = json.loads(body.decode('utf-8'))['files']
+            stage = '{0}-{1}'.format(parts[0], uuid.uuid4().hex[:12])
+            package['stages'][stage] = files
+            if self.validation_delay:
+                self.validating.append((time.time() + self.validation_delay,
+                                        parts[0],
+                                        stage))
+            else:
+                package['active-stage'] = stage
+            return 200, {'results': [{'code': 200, 'package': parts[0],
+                                      'stage': stage,
+                                      'status': 'Created stage.'}]}
+        if len(parts) == 2 and method == 'GET':
+            files = package['stages'].get(parts[1])
+            if files is None:
+                return 404, {'error': 404, 'status': 'Stage not found'}
+            return 200, {'results': [{'type': 'file', 'name': name}
+                                     for name in sorted(files)]}
+        return 404, {'error': 404, 'status': 'Not found'}
+
+    def handle_file(self, parts):
+        """
+            Return raw content of stage file
+        """
+        package = self.packages.get(parts[0]) if parts else None
+        if package is None or len(parts) < 3:
+            return 404, {'error': 404, 'status': 'Not found'}
+        files = package['stages'].get(parts[1], {})
+        content = files.get('/'.join(parts[2:]))
+        if content is None:
+            return 404, {'error': 404, 'status': 'File not found'}
+        return 200, content.encode('utf-8')
+
+    def handle_downtime(self, body):
+        """
+            Record scheduled downtime
+        """
+        data = json.loads(body.decode('utf-8'))
+        self.downtimes.append(data)
+        hosts = data.get('filter_vars', {}).get('hosts', [])
+        return 200, {'results': [{'code': 200,
+                                  'status': 'Successfully scheduled downtime.',
+                                  'name': host} for host in hosts]}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+        HTTP request handler forwarding API requests to FakeIcinga
+    """
+    protocol_version = 'HTTP/1.1'
+    icinga = None
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, payload = self.icinga.handle(self.command, self.path, body)
+        if isinstance(payload, bytes):
+            data = payload
+            content_type = 'application/octet-stream'
+        else:
+            data = json.dumps(payload).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = respond
+    do_POST = respond
+    do_DELETE = respond
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    """
+        Serve fake Icinga2 API until interrupted
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5665)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random seconds added on top of latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of answering with 500 error')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='requests per second before answering with 429')
+    parser.add_argument('--validation-delay', type=float, default=0.0,
+                        help='seconds before uploaded stage becomes active')
+    parser.add_argument('--reload-errors', action='store_true',
+                        help='answer with 503 while stage is validated')
+    parser.add_argument('--seed', type=int, help='random generator seed')
+    args = parser.parse_args()
+
+    server = FakeIcinga(args.host,
+                        args.port,
+                        latency=args.latency,
+                        jitter=args.jitter,
+                        error_rate=args.error_rate,
+                        rate_limit=args.rate_limit,
+                        validation_delay=args.validation_delay,
+                        reload_errors=args.reload_errors,
+                        seed=args.seed).start()
+    print('Fake Icinga2 API listening on https://{0}:{1}'.format(server.host,
+                                                                 server.port))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats(), sort_keys=True))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+    Replay recorded Lambda events against lambda2icinga function.
+
+    By default only prints provisioning plan coalesced from the event,
+    without calling any AWS or Icinga2 API. With --apply the event is passed
+    to index.handler, using environment variables described in src/index.py
+
+    Usage:
+        python tools/replay.py tools/fixtures/autoscaling-burst.json
+        python tools/replay.py --apply event.json
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import index  # noqa: E402
+
+
+def describe_plan(plan):
+    """
+        Convert provisioning plan into JSON serializable structure
+    """
+    instances = {}
+    for instance_id, entry in sorted(plan['instances'].items()):
+        instances[instance_id] = {
+            'action': entry['action'],
+            'kinds': None if entry['kinds'] is None else sorted(entry['kinds']),
+            'downtime': entry['downtime']}
+    return {'instances': instances,
+            'templates': ['/'.join(item) for item in sorted(plan['templates'])]}
+
+
+def main():
+    """
+        Replay event fixture
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('fixture', help='JSON file with Lambda event')
+    parser.add_argument('--apply',
+                        action='store_true',
+                        help='invoke index.handler with the event')
+    args = parser.parse_args()
+
+    with open(args.fixture) as fixture:
+        event = json.load(fixture)
+
+    if args.apply:
+        results = index.handler(event, None)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    if event.get('Records', [{}])[0].get('eventSource') == 'aws:sqs':
+        plan = index.plan_batch(event['Records'])
+    else:
+        plan = index.new_plan()
+        index.add_event_to_plan(plan, event)
+    print(json.dumps(describe_plan(plan), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()